@@ -0,0 +1,291 @@
+#!/usr/bin/env python3
+"""
+JSON API for programmatic invoice creation
+
+A small ASGI application next to the Streamlit app, for POS and booking
+tools. It uses the same db layer and PDF renderer:
+
+    POST /invoices                create an invoice
+    GET  /invoices/{id}           invoice with its items
+    GET  /invoices/{id}/pdf       invoice as PDF
+    GET  /customers?q=...         search customers by name or KFZ
+    GET  /services                service catalogue
+
+Handlers never block the event loop: writes are awaited on the db writer's
+future, reads run in worker threads and PDF rendering runs in a
+process pool. Serve it with any ASGI server, e.g.
+
+    uvicorn api:app --port 8502
+
+For tests the app can be called in-process, e.g. through
+httpx.AsyncClient(transport=httpx.ASGITransport(app=app)).
+"""
+
+import asyncio
+import json
+import math
+import multiprocessing
+import re
+import sqlite3
+import traceback
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from datetime import date
+from urllib.parse import parse_qs
+
+import db
+from pdf_generator import render_invoice_pdf
+
+MAX_BODY_SIZE = 1024 * 1024
+MAX_SUBTOTAL = 1_000_000.0
+SQLITE_MAX_INTEGER = 2 ** 63 - 1
+PAYMENT_METHODS = ("Bar", "Karte", "Überweisung", "PayPal")
+
+_render_pool = None
+
+
+class HTTPError(Exception):
+    def __init__(self, status, message):
+        super().__init__(message)
+        self.status = status
+        self.message = message
+
+
+def _get_render_pool():
+    global _render_pool
+    if _render_pool is None:
+        # spawn, not fork: this process runs the db writer thread, which must not be copied
+        _render_pool = ProcessPoolExecutor(max_workers=2, mp_context=multiprocessing.get_context("spawn"))
+    return _render_pool
+
+
+def _reset_render_pool():
+    global _render_pool
+    if _render_pool is not None:
+        _render_pool.shutdown(wait=False, cancel_futures=True)
+        _render_pool = None
+
+
+def _row(row):
+    return dict(row) if row is not None else None
+
+
+def _invoice_id(raw):
+    # The route only guarantees digits; larger ids cannot exist in SQLite
+    invoice_id = int(raw)
+    if invoice_id > SQLITE_MAX_INTEGER:
+        raise HTTPError(404, "invoice not found")
+    return invoice_id
+
+
+def _number(value, field):
+    """Parse a finite number; bools, NaN and infinity are rejected"""
+    if isinstance(value, bool):
+        raise HTTPError(400, f"{field} must be a number")
+    try:
+        number = float(value)
+    except (TypeError, ValueError):
+        raise HTTPError(400, f"{field} must be a number")
+    if not math.isfinite(number):
+        raise HTTPError(400, f"{field} must be a finite number")
+    return number
+
+
+def _parse_customer(raw):
+    if not isinstance(raw, dict):
+        raise HTTPError(400, "customer must be an object")
+    for field in ("name", "kfz", "tel", "email"):
+        if raw.get(field) is not None and not isinstance(raw[field], str):
+            raise HTTPError(400, f"customer.{field} must be a string")
+    if not (raw.get("name") or "").strip() or not (raw.get("kfz") or "").strip():
+        raise HTTPError(400, "customer.name and customer.kfz are required")
+    email = raw.get("email")
+    if email is not None and ("@" not in email or any(c in email for c in "\r\n")):
+        raise HTTPError(400, "customer.email must be a valid e-mail address")
+    return raw
+
+
+def _parse_date(raw):
+    if raw is None:
+        return None
+    if not isinstance(raw, str):
+        raise HTTPError(400, "date must be a string (YYYY-MM-DD)")
+    try:
+        return date.fromisoformat(raw).isoformat()
+    except ValueError:
+        raise HTTPError(400, "date must be a valid date (YYYY-MM-DD)")
+
+
+def _parse_items(raw_items, services):
+    if not isinstance(raw_items, list) or not raw_items:
+        raise HTTPError(400, "items must be a non-empty list")
+    items = []
+    for raw in raw_items:
+        if not isinstance(raw, dict):
+            raise HTTPError(400, "every item must be an object")
+        name = raw.get("service_name")
+        if not isinstance(name, str) or not name:
+            raise HTTPError(400, "every item needs a service_name")
+        qty = _number(raw.get("qty", 1), f"qty of '{name}'")
+        unit_price = raw.get("unit_price")
+        if unit_price is None:
+            if name not in services:
+                raise HTTPError(400, f"unknown service '{name}', unit_price required")
+            unit_price = services[name]
+        unit_price = _number(unit_price, f"unit_price of '{name}'")
+        if qty <= 0 or unit_price < 0:
+            raise HTTPError(400, f"invalid qty or unit_price for '{name}'")
+        items.append({"service_name": name, "qty": qty, "unit_price": unit_price})
+    return items
+
+
+async def create_invoice(request):
+    body = request["json"]
+    customer = _parse_customer(body.get("customer"))
+    zahlart = body.get("zahlart", "Bar")
+    if zahlart not in PAYMENT_METHODS:
+        raise HTTPError(400, f"zahlart must be one of {', '.join(PAYMENT_METHODS)}")
+    rabatt = _number(body.get("rabatt", 0.0), "rabatt")
+    invoice_date = _parse_date(body.get("date"))
+
+    services = {s["name"]: s["standard_price"] for s in await asyncio.to_thread(db.get_all_services)}
+    items = _parse_items(body.get("items"), services)
+    subtotal = sum(item["qty"] * item["unit_price"] for item in items)
+    # Finite operands can still overflow to inf when multiplied
+    if not math.isfinite(subtotal) or subtotal > MAX_SUBTOTAL:
+        raise HTTPError(400, f"subtotal must not exceed {MAX_SUBTOTAL:.2f}")
+    if not 0 <= rabatt <= subtotal:
+        raise HTTPError(400, "rabatt must be between 0 and the subtotal")
+
+    future = db.submit_create_invoice(customer["name"], customer["kfz"], customer.get("tel"),
+                                      items, rabatt, zahlart, invoice_date, customer.get("email"))
+    invoice_id, _ = await asyncio.wrap_future(future)
+    invoice, invoice_items = await asyncio.to_thread(db.get_invoice_details, invoice_id)
+    return 201, {**_row(invoice), "items": [_row(item) for item in invoice_items]}
+
+
+async def get_invoice(request, invoice_id):
+    invoice, items = await asyncio.to_thread(db.get_invoice_details, _invoice_id(invoice_id))
+    if invoice is None:
+        raise HTTPError(404, "invoice not found")
+    return 200, {**_row(invoice), "items": [_row(item) for item in items]}
+
+
+async def get_invoice_pdf(request, invoice_id):
+    invoice, items = await asyncio.to_thread(db.get_invoice_details, _invoice_id(invoice_id))
+    if invoice is None:
+        raise HTTPError(404, "invoice not found")
+    customer = await asyncio.to_thread(db.get_customer_by_id, invoice["customer_id"])
+    loop = asyncio.get_running_loop()
+    # Rows are converted to dicts so they can be sent to the render process
+    try:
+        pdf_bytes = await loop.run_in_executor(_get_render_pool(), render_invoice_pdf,
+                                               _row(invoice), _row(customer), [_row(item) for item in items])
+    except BrokenProcessPool:
+        # A render process died; the next request starts a fresh pool
+        _reset_render_pool()
+        raise HTTPError(503, "PDF rendering unavailable, please retry")
+    return 200, pdf_bytes
+
+
+async def search_customers(request):
+    query = request["query"].get("q", [""])[0]
+    customers = await asyncio.to_thread(db.search_customers, query)
+    return 200, [_row(customer) for customer in customers]
+
+
+async def list_services(request):
+    services = await asyncio.to_thread(db.get_all_services)
+    return 200, [_row(service) for service in services]
+
+
+ROUTES = [
+    ("POST", re.compile(r"^/invoices$"), create_invoice),
+    ("GET", re.compile(r"^/invoices/(\d+)$"), get_invoice),
+    ("GET", re.compile(r"^/invoices/(\d+)/pdf$"), get_invoice_pdf),
+    ("GET", re.compile(r"^/customers$"), search_customers),
+    ("GET", re.compile(r"^/services$"), list_services),
+]
+
+
+async def _read_body(receive):
+    body = b""
+    more_body = True
+    while more_body:
+        message = await receive()
+        body += message.get("body", b"")
+        if len(body) > MAX_BODY_SIZE:
+            raise HTTPError(413, "request body too large")
+        more_body = message.get("more_body", False)
+    return body
+
+
+async def _send(send, status, payload):
+    if isinstance(payload, bytes):
+        content_type = b"application/pdf"
+        body = payload
+    else:
+        content_type = b"application/json"
+        try:
+            body = json.dumps(payload, ensure_ascii=False, allow_nan=False).encode("utf-8")
+        except ValueError:
+            # NaN/Infinity in stored data; never answer with non-standard JSON
+            status = 500
+            body = b'{"error": "response contains non-finite numbers"}'
+    await send({
+        "type": "http.response.start",
+        "status": status,
+        "headers": [(b"content-type", content_type), (b"content-length", str(len(body)).encode())],
+    })
+    await send({"type": "http.response.body", "body": body})
+
+
+async def _lifespan(receive, send):
+    while True:
+        message = await receive()
+        if message["type"] == "lifespan.startup":
+            await asyncio.to_thread(db.init_db)
+            await send({"type": "lifespan.startup.complete"})
+        elif message["type"] == "lifespan.shutdown":
+            if _render_pool is not None:
+                _render_pool.shutdown()
+            await send({"type": "lifespan.shutdown.complete"})
+            return
+
+
+async def app(scope, receive, send):
+    if scope["type"] == "lifespan":
+        await _lifespan(receive, send)
+        return
+    if scope["type"] != "http":
+        return
+
+    try:
+        path_matched = False
+        for method, pattern, handler in ROUTES:
+            match = pattern.match(scope["path"])
+            if not match:
+                continue
+            path_matched = True
+            if method != scope["method"]:
+                continue
+            request = {"query": parse_qs(scope.get("query_string", b"").decode("utf-8"))}
+            if method == "POST":
+                try:
+                    request["json"] = json.loads(await _read_body(receive) or b"{}")
+                except json.JSONDecodeError:
+                    raise HTTPError(400, "invalid JSON body")
+                if not isinstance(request["json"], dict):
+                    raise HTTPError(400, "JSON body must be an object")
+            status, payload = await handler(request, *match.groups())
+            await _send(send, status, payload)
+            return
+        raise HTTPError(405 if path_matched else 404, "method not allowed" if path_matched else "not found")
+    except HTTPError as e:
+        await _send(send, e.status, {"error": e.message})
+    except sqlite3.IntegrityError as e:
+        await _send(send, 409, {"error": str(e)})
+    except Exception:
+        # Every request gets an answer, even on a bug
+        traceback.print_exc()
+        await _send(send, 500, {"error": "internal server error"})
@@ -1,17 +1,42 @@
 import streamlit as st
 import pandas as pd
-from datetime import datetime
+import config
 import db
+import maintenance
+import pdf_renderer_pool
+from generate_pdf import build_invoice_html_from_db
 from pdf_generator import InvoicePDF
 import os
 
 # Initialize the database
 db.init_db()
 
+# Daily online backup and maintenance, started once per process
+maintenance.start_maintenance_scheduler()
+
+# Warm WeasyPrint workers for the HTML invoice template; they start in the background
+renderer_pool = pdf_renderer_pool.get_renderer_pool()
+
 st.set_page_config(layout="wide", page_title="Glanzwerk Rheinland Invoicing")
 
 st.title("Glanzwerk Rheinland - Rechnungssystem")
 
+def show_customer_summary(customer):
+    """Lifetime figures of a known customer, read from the precomputed customer stats"""
+    stats = db.get_customer_stats(customer["id"])
+    if not stats or not stats["invoice_count"]:
+        st.info(f"Bekannter Kunde: {customer['name']} (noch keine Rechnungen)")
+        return
+    col1, col2, col3, col4 = st.columns(4)
+    col1.metric("Rechnungen", stats["invoice_count"])
+    col2.metric("Umsatz netto", f"{stats['net_revenue']:.2f}€")
+    col3.metric("Umsatz brutto", f"{stats['gross_revenue']:.2f}€")
+    col4.metric("Letzter Besuch", stats["last_visit"])
+    top_services = db.get_top_services(customer["id"])
+    if top_services:
+        st.caption("Häufigste Services: " + ", ".join(f"{s['service_name']} ({s['uses']}x)" for s in top_services))
+    st.caption(f"Kunde seit {stats['first_visit']}")
+
 # --- Main App ---
 
 menu = ["Neue Rechnung", "Services verwalten", "Kundenhistorie"]
@@ -25,6 +50,10 @@ if choice == "Neue Rechnung":
         customer_name = st.text_input("Kundenname")
         kfz = st.text_input("KFZ-Kennzeichen")
         tel = st.text_input("Telefon (optional)")
+        email = st.text_input("E-Mail (optional)", help="Für den Rechnungsversand per E-Mail").strip()
+        known_customer = db.get_customer_by_kfz(kfz) if kfz else None
+        if known_customer:
+            show_customer_summary(known_customer)
 
     # Invoice Items
     st.subheader("Rechnungspositionen")
@@ -75,13 +104,23 @@ if choice == "Neue Rechnung":
     # Summary
     st.subheader("Zusammenfassung")
     subtotal = sum(item["line_total"] for item in st.session_state.invoice_items)
-    discount = st.number_input("Rabatt (fester Betrag)", min_value=0.0, step=5.0)
+    suggested_discount = 0.0
+    if known_customer and db.is_stammkunde(known_customer["id"]):
+        suggested_discount = round(subtotal * config.STAMMKUNDEN_RABATT, 2)
+        st.info(f"Stammkunde: {config.STAMMKUNDEN_RABATT:.0%} Stammkundenrabatt vorgeschlagen")
+    # The suggestion is put into the widget state once per customer and subtotal,
+    # so a manually changed discount survives reruns
+    suggestion_for = (known_customer["id"] if known_customer else None, subtotal)
+    if st.session_state.get("rabatt_suggested_for") != suggestion_for:
+        st.session_state.rabatt_suggested_for = suggestion_for
+        st.session_state.rabatt = suggested_discount
+    discount = st.number_input("Rabatt (fester Betrag)", min_value=0.0, step=5.0, key="rabatt")
     total_before_vat = subtotal - discount
-    vat = total_before_vat * 0.19
+    vat = total_before_vat * config.VAT_RATE
     final_total = total_before_vat + vat
 
     st.metric("Zwischensumme", f"{subtotal:.2f}€")
-    st.metric("MwSt. (19%)", f"{vat:.2f}€")
+    st.metric(f"MwSt. ({config.VAT_RATE:.0%})", f"{vat:.2f}€")
     st.metric("Gesamtsumme", f"{final_total:.2f}€")
 
     payment_method = st.selectbox("Zahlungsart", ["Bar", "Karte", "Überweisung", "PayPal"])
@@ -91,42 +130,23 @@ if choice == "Neue Rechnung":
             st.error("Bitte Kundennamen und KFZ-Kennzeichen eingeben.")
         elif not st.session_state.invoice_items:
             st.error("Bitte mindestens eine Rechnungsposition hinzufügen.")
+        elif email and ("@" not in email or any(c in email for c in "\r\n")):
+            st.error("Bitte eine gültige E-Mail-Adresse eingeben.")
         else:
-            # Save customer
-            customer = db.get_customer_by_kfz(kfz)
-            if not customer:
-                customer_id = db.insert_customer(customer_name, kfz, tel)
-            else:
-                customer_id = customer["id"]
-
-            # Generate invoice number
-            latest_invoice_nr = db.get_latest_invoice_number()
-            if latest_invoice_nr:
-                year = datetime.now().year
-                last_number = int(latest_invoice_nr.split("-")[1])
-                new_invoice_nr = f"{year}-{last_number + 1:04d}"
-            else:
-                new_invoice_nr = f"{datetime.now().year}-1001"
-
-            # Save invoice
-            invoice_id = db.insert_invoice(
-                nr=new_invoice_nr,
-                date=datetime.now().strftime("%Y-%m-%d"),
-                customer_id=customer_id,
-                subtotal=subtotal,
+            # Save customer, invoice and items in one transaction
+            invoice_id, new_invoice_nr = db.create_invoice(
+                customer_name=customer_name,
+                kfz=kfz,
+                tel=tel,
+                items=st.session_state.invoice_items,
                 rabatt=discount,
-                mwst=vat,
-                total=final_total,
-                zahlart=payment_method
+                zahlart=payment_method,
+                email=email or None
             )
 
-            # Save invoice items
-            for item in st.session_state.invoice_items:
-                db.insert_invoice_item(invoice_id, item["service_name"], item["qty"], item["unit_price"], item["line_total"])
-
             # Generate PDF
             invoice_data, invoice_items_from_db = db.get_invoice_details(invoice_id)
-            customer_data = db.get_customer_by_kfz(kfz)
+            customer_data = db.get_customer_by_id(invoice_data["customer_id"])
             pdf = InvoicePDF()
             pdf.create_invoice(invoice_data, customer_data, invoice_items_from_db)
             pdf_filename = f"Rechnung_{customer_name.replace(' ', '_')}_{new_invoice_nr}.pdf"
@@ -136,6 +156,15 @@ if choice == "Neue Rechnung":
             with open(pdf_filename, "rb") as f:
                 st.download_button("PDF herunterladen", f, file_name=pdf_filename)
 
+            # The same invoice in the HTML design, rendered by the warm worker pool
+            try:
+                html_pdf = renderer_pool.render(build_invoice_html_from_db(invoice_data, customer_data, invoice_items_from_db))
+            except Exception as e:
+                st.warning(f"Rechnung im HTML-Design konnte nicht erstellt werden: {e}")
+            else:
+                st.download_button("PDF (HTML-Design) herunterladen", html_pdf,
+                                   file_name=f"Rechnung_{new_invoice_nr}_Design.pdf", mime="application/pdf")
+
             # Clear session state for next invoice
             st.session_state.invoice_items = []
 
@@ -166,6 +195,7 @@ elif choice == "Kundenhistorie":
     if selected_customer_name:
         customer = next((c for c in customers if c["name"] == selected_customer_name), None)
         if customer:
+            show_customer_summary(customer)
             invoices = db.get_invoices_by_customer(customer["id"])
             if invoices:
                 invoices_df = pd.DataFrame(invoices, columns=["id", "nr", "date", "total", "zahlart"])
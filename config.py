@@ -9,4 +9,21 @@ BANK_NAME = "xxxxxxxxxxxxxx"
 IBAN = "xxxxxxxxxxxxxxxx"
 BIC = "0123"
 
+# Outgoing mail server for invoice delivery (mail_delivery.py)
+SMTP_HOST = "localhost"
+SMTP_PORT = 25
+SMTP_USER = None
+SMTP_PASSWORD = None
+SMTP_STARTTLS = False
 
+# Structured seller data for e-invoices (einvoice.py)
+COMPANY_STREET = "Krasnaer Str. 1"
+COMPANY_POSTCODE = "56566"
+COMPANY_CITY = "Neuwied"
+COMPANY_COUNTRY = "DE"
+COMPANY_VAT_ID = "DExxxxxxxxx"
+PAYMENT_TERM_DAYS = 14
+
+# Stammkundenrabatt: granted from this many previous invoices on
+STAMMKUNDE_MIN_INVOICES = 5
+STAMMKUNDEN_RABATT = 0.10
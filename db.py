@@ -1,10 +1,20 @@
 
 import sqlite3
+from datetime import datetime
+from itertools import groupby
+
+import config
+from db_writer import get_writer
 
 DATABASE_NAME = 'glanzwerk.db'
 
+# Seconds a connection waits for a lock held by another connection or process
+BUSY_TIMEOUT = 30
+
 def init_db():
-    conn = sqlite3.connect(DATABASE_NAME)
+    conn = sqlite3.connect(DATABASE_NAME, timeout=BUSY_TIMEOUT)
+    # WAL lets readers continue while the writer commits; the setting is stored in the file
+    conn.execute('PRAGMA journal_mode=WAL')
     cursor = conn.cursor()
     cursor.execute('''
         CREATE TABLE IF NOT EXISTS customers (
@@ -35,40 +45,407 @@ def init_db():
             FOREIGN KEY (customer_id) REFERENCES customers(id)
         )
     ''')
+    _create_invoice_lines(cursor)
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS invoice_deliveries (
+            invoice_id INTEGER PRIMARY KEY,
+            recipient TEXT,
+            status TEXT NOT NULL,
+            attempts INTEGER NOT NULL DEFAULT 0,
+            error TEXT,
+            updated_at TEXT NOT NULL,
+            FOREIGN KEY (invoice_id) REFERENCES invoices(id)
+        )
+    ''')
+    # Older databases were created before customers had an e-mail address
+    columns = [row[1] for row in cursor.execute('PRAGMA table_info(customers)')]
+    if 'email' not in columns:
+        cursor.execute('ALTER TABLE customers ADD COLUMN email TEXT')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_invoices_customer ON invoices (customer_id, date)')
+    _create_customer_stats(cursor)
+    _create_vehicles(cursor)
+    conn.commit()
+    conn.close()
+
+def normalize_kfz(kfz):
+    """
+    Canonical form of a licence plate: upper case, the separator after the
+    district kept as one '-', later separators dropped. "nr ab123" and
+    "NR-AB 123" both become "NR-AB123", while "K-AB 1" (Köln) and "KA-B 1"
+    (Karlsruhe) stay different plates.
+    """
+    runs = [''.join(chars) for is_alnum, chars in groupby(kfz.upper(), str.isalnum) if is_alnum]
+    if not runs:
+        # Never let a plate without letters or digits collapse into the empty key of another one
+        return kfz.strip()
+    return runs[0] + ('-' + ''.join(runs[1:]) if len(runs) > 1 else '')
+
+def _create_vehicles(cursor):
+    """One customer can have several vehicles; plates are matched on their normalized form"""
+    exists = cursor.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'vehicles'").fetchone()
+    # customer_id is only NULL inside the upsert transaction that creates the customer
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS vehicles (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            customer_id INTEGER,
+            kfz TEXT NOT NULL,
+            kfz_normalized TEXT NOT NULL UNIQUE,
+            FOREIGN KEY (customer_id) REFERENCES customers(id)
+        )
+    ''')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_vehicles_customer ON vehicles (customer_id)')
+    columns = [row[1] for row in cursor.execute('PRAGMA table_info(invoices)')]
+    if 'vehicle_id' not in columns:
+        cursor.execute('ALTER TABLE invoices ADD COLUMN vehicle_id INTEGER REFERENCES vehicles(id)')
+    if not exists:
+        # Existing customers get their vehicle; customers sharing a plate are only
+        # merged on request (maintenance.py dedup-customers), never implicitly
+        _link_vehicles(cursor)
+    elif cursor.execute("SELECT 1 FROM vehicles WHERE kfz_normalized NOT LIKE '%-%' "
+                        "AND (kfz LIKE '%-%' OR kfz LIKE '% %') LIMIT 1").fetchone():
+        # Keys from before the district separator was kept
+        _renormalize_vehicles(cursor)
+
+def _renormalize_vehicles(conn):
+    # The new keys only split what the old ones merged, so they cannot collide
+    for vehicle_id, kfz, kfz_normalized in conn.execute('SELECT id, kfz, kfz_normalized FROM vehicles').fetchall():
+        if normalize_kfz(kfz) != kfz_normalized:
+            conn.execute('UPDATE vehicles SET kfz_normalized = ? WHERE id = ?', (normalize_kfz(kfz), vehicle_id))
+
+def _link_vehicles(conn):
+    """Create the vehicle of every customer whose plate has none yet and link its invoices"""
+    for customer_id, kfz in conn.execute('SELECT id, kfz FROM customers ORDER BY id').fetchall():
+        kfz_normalized = normalize_kfz(kfz)
+        if conn.execute('SELECT 1 FROM vehicles WHERE kfz_normalized = ?', (kfz_normalized,)).fetchone():
+            continue
+        vehicle_id = conn.execute('INSERT INTO vehicles (customer_id, kfz, kfz_normalized) VALUES (?, ?, ?)',
+                                  (customer_id, kfz, kfz_normalized)).lastrowid
+        conn.execute('UPDATE invoices SET vehicle_id = ? WHERE customer_id = ? AND vehicle_id IS NULL',
+                     (vehicle_id, customer_id))
+
+def _dedup_customers(conn, apply):
+    """
+    Find customers whose plate belongs to another customer's vehicle and, if
+    apply is set, merge them into that customer
+
+    Returns:
+        List of (customer_id, name, keeper_id, keeper_name, kfz) merges
+    """
+    if apply:
+        _link_vehicles(conn)
+    merges = []
+    customers = conn.execute('SELECT id, name, kfz, tel, email FROM customers ORDER BY id').fetchall()
+    for customer_id, name, kfz, tel, email in customers:
+        vehicle = conn.execute('SELECT v.id, v.customer_id, c.name FROM vehicles v JOIN customers c ON c.id = v.customer_id '
+                               'WHERE v.kfz_normalized = ?', (normalize_kfz(kfz),)).fetchone()
+        if vehicle is None or vehicle[1] == customer_id:
+            continue
+        vehicle_id, keeper_id, keeper_name = vehicle
+        merges.append((customer_id, name, keeper_id, keeper_name, kfz))
+        if not apply:
+            continue
+
+        conn.execute('UPDATE invoices SET vehicle_id = ? WHERE customer_id = ? AND vehicle_id IS NULL',
+                     (vehicle_id, customer_id))
+        conn.execute('UPDATE invoices SET customer_id = ? WHERE customer_id = ?', (keeper_id, customer_id))
+        conn.execute('UPDATE vehicles SET customer_id = ? WHERE customer_id = ?', (keeper_id, customer_id))
+        conn.execute('UPDATE customers SET tel = COALESCE(tel, ?), email = COALESCE(email, ?) WHERE id = ?',
+                     (tel, email, keeper_id))
+        conn.execute('DELETE FROM customers WHERE id = ?', (customer_id,))
+    if apply and merges:
+        _rebuild_customer_stats(conn)
+    return merges
+
+def find_duplicate_customers():
+    """List the merges dedup_customers would make, without changing anything"""
+    conn = get_db_connection()
+    merges = _dedup_customers(conn, False)
+    conn.close()
+    return merges
+
+def dedup_customers():
+    """Merge duplicate customers of the same vehicle and repoint their invoices; returns the merges made"""
+    return run_write(_dedup_customers, True)
+
+def _create_invoice_lines(cursor):
+    """
+    Line items reference services.id and an interned description instead of
+    repeating the full service text on every line. unit_price is the price
+    at the time of sale. The invoice_items view keeps the old row shape for
+    reads and inserts.
+    """
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS item_descriptions (
+            id INTEGER PRIMARY KEY,
+            text TEXT NOT NULL UNIQUE
+        )
+    ''')
     cursor.execute('''
-        CREATE TABLE IF NOT EXISTS invoice_items (
+        CREATE TABLE IF NOT EXISTS invoice_lines (
             id INTEGER PRIMARY KEY AUTOINCREMENT,
             invoice_id INTEGER NOT NULL,
-            service_name TEXT NOT NULL,
+            service_id INTEGER,
+            description_id INTEGER NOT NULL,
             qty REAL NOT NULL,
             unit_price REAL NOT NULL,
             line_total REAL NOT NULL,
-            FOREIGN KEY (invoice_id) REFERENCES invoices(id)
+            FOREIGN KEY (invoice_id) REFERENCES invoices(id),
+            FOREIGN KEY (service_id) REFERENCES services(id),
+            FOREIGN KEY (description_id) REFERENCES item_descriptions(id)
         )
     ''')
-    conn.commit()
-    conn.close()
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_invoice_lines_invoice ON invoice_lines (invoice_id)')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_invoice_lines_service ON invoice_lines (service_id)')
+
+    # Databases from before the normalisation still have invoice_items as a table
+    if cursor.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'invoice_items'").fetchone():
+        cursor.execute('INSERT OR IGNORE INTO item_descriptions (text) SELECT DISTINCT service_name FROM invoice_items')
+        cursor.execute('''
+            INSERT INTO invoice_lines (id, invoice_id, service_id, description_id, qty, unit_price, line_total)
+            SELECT it.id, it.invoice_id, s.id, d.id, it.qty, it.unit_price, it.line_total
+            FROM invoice_items it
+            JOIN item_descriptions d ON d.text = it.service_name
+            LEFT JOIN services s ON s.name = it.service_name
+        ''')
+        cursor.execute('DROP TABLE invoice_items')
+
+    cursor.execute('''
+        CREATE VIEW IF NOT EXISTS invoice_items AS
+        SELECT l.id, l.invoice_id, d.text AS service_name, l.qty, l.unit_price, l.line_total
+        FROM invoice_lines l
+        JOIN item_descriptions d ON d.id = l.description_id
+    ''')
+    cursor.execute('''
+        CREATE TRIGGER IF NOT EXISTS trg_invoice_items_insert INSTEAD OF INSERT ON invoice_items BEGIN
+            INSERT OR IGNORE INTO item_descriptions (text) VALUES (NEW.service_name);
+            INSERT INTO invoice_lines (invoice_id, service_id, description_id, qty, unit_price, line_total)
+            VALUES (NEW.invoice_id,
+                    (SELECT id FROM services WHERE name = NEW.service_name),
+                    (SELECT id FROM item_descriptions WHERE text = NEW.service_name),
+                    NEW.qty, NEW.unit_price, NEW.line_total);
+        END
+    ''')
+    cursor.execute('''
+        CREATE TRIGGER IF NOT EXISTS trg_invoice_items_delete INSTEAD OF DELETE ON invoice_items BEGIN
+            DELETE FROM invoice_lines WHERE id = OLD.id;
+        END
+    ''')
+
+# Recomputes one customer's aggregates from invoices; {customer} is an SQL expression
+_CUSTOMER_STATS_REFRESH = '''
+    INSERT OR REPLACE INTO customer_stats (customer_id, invoice_count, net_revenue, gross_revenue, first_visit, last_visit)
+    SELECT {customer}, COUNT(*), COALESCE(SUM(subtotal - rabatt), 0), COALESCE(SUM(total), 0), MIN(date), MAX(date)
+    FROM invoices WHERE customer_id = {customer};
+'''
+
+def _create_customer_stats(cursor):
+    """Per-customer aggregates kept current by triggers, so lookups are a primary-key read"""
+    exists = cursor.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'customer_stats'").fetchone()
+    # Service counts used to be keyed on the service text; they are derived data, so rebuild them
+    if 'service_name' in [row[1] for row in cursor.execute('PRAGMA table_info(customer_service_stats)')]:
+        cursor.execute('DROP TABLE customer_service_stats')
+        exists = None
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS customer_stats (
+            customer_id INTEGER PRIMARY KEY,
+            invoice_count INTEGER NOT NULL DEFAULT 0,
+            net_revenue REAL NOT NULL DEFAULT 0.0,
+            gross_revenue REAL NOT NULL DEFAULT 0.0,
+            first_visit TEXT,
+            last_visit TEXT,
+            FOREIGN KEY (customer_id) REFERENCES customers(id)
+        )
+    ''')
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS customer_service_stats (
+            customer_id INTEGER NOT NULL,
+            description_id INTEGER NOT NULL,
+            uses INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (customer_id, description_id),
+            FOREIGN KEY (customer_id) REFERENCES customers(id),
+            FOREIGN KEY (description_id) REFERENCES item_descriptions(id)
+        ) WITHOUT ROWID
+    ''')
+    # New invoices are the hot path and only add to the running totals
+    cursor.execute('''
+        CREATE TRIGGER IF NOT EXISTS trg_customer_stats_insert AFTER INSERT ON invoices BEGIN
+            INSERT OR IGNORE INTO customer_stats (customer_id) VALUES (NEW.customer_id);
+            UPDATE customer_stats SET
+                invoice_count = invoice_count + 1,
+                net_revenue = net_revenue + NEW.subtotal - NEW.rabatt,
+                gross_revenue = gross_revenue + NEW.total,
+                first_visit = MIN(COALESCE(first_visit, NEW.date), NEW.date),
+                last_visit = MAX(COALESCE(last_visit, NEW.date), NEW.date)
+            WHERE customer_id = NEW.customer_id;
+        END
+    ''')
+    # Corrections are rare, so they simply recompute the affected customers. Only
+    # columns the stats depend on fire it, not e.g. the vehicle_id backfill; older
+    # databases have it without a column list, so it is replaced once
+    trigger = cursor.execute("SELECT sql FROM sqlite_master WHERE type = 'trigger' "
+                             "AND name = 'trg_customer_stats_update'").fetchone()
+    if trigger is not None and 'UPDATE OF' not in trigger[0]:
+        cursor.execute('DROP TRIGGER trg_customer_stats_update')
+    cursor.execute('''
+        CREATE TRIGGER IF NOT EXISTS trg_customer_stats_update
+        AFTER UPDATE OF customer_id, date, subtotal, rabatt, total ON invoices BEGIN
+            {old}
+            {new}
+        END
+    '''.format(old=_CUSTOMER_STATS_REFRESH.format(customer='OLD.customer_id'),
+               new=_CUSTOMER_STATS_REFRESH.format(customer='NEW.customer_id')))
+    cursor.execute('''
+        CREATE TRIGGER IF NOT EXISTS trg_customer_stats_delete AFTER DELETE ON invoices BEGIN
+            {old}
+        END
+    '''.format(old=_CUSTOMER_STATS_REFRESH.format(customer='OLD.customer_id')))
+    cursor.execute('''
+        CREATE TRIGGER IF NOT EXISTS trg_customer_service_stats_insert AFTER INSERT ON invoice_lines BEGIN
+            INSERT OR IGNORE INTO customer_service_stats (customer_id, description_id)
+                SELECT customer_id, NEW.description_id FROM invoices WHERE id = NEW.invoice_id;
+            UPDATE customer_service_stats SET uses = uses + 1
+            WHERE customer_id = (SELECT customer_id FROM invoices WHERE id = NEW.invoice_id)
+              AND description_id = NEW.description_id;
+        END
+    ''')
+    cursor.execute('''
+        CREATE TRIGGER IF NOT EXISTS trg_customer_service_stats_delete AFTER DELETE ON invoice_lines BEGIN
+            UPDATE customer_service_stats SET uses = uses - 1
+            WHERE customer_id = (SELECT customer_id FROM invoices WHERE id = OLD.invoice_id)
+              AND description_id = OLD.description_id;
+        END
+    ''')
+    # An invoice moved to another customer takes its service counts along
+    cursor.execute('''
+        CREATE TRIGGER IF NOT EXISTS trg_customer_service_stats_move
+        AFTER UPDATE OF customer_id ON invoices WHEN OLD.customer_id IS NOT NEW.customer_id BEGIN
+            UPDATE customer_service_stats SET uses = uses - (
+                SELECT COUNT(*) FROM invoice_lines
+                WHERE invoice_id = NEW.id AND description_id = customer_service_stats.description_id)
+            WHERE customer_id = OLD.customer_id
+              AND description_id IN (SELECT description_id FROM invoice_lines WHERE invoice_id = NEW.id);
+            INSERT OR IGNORE INTO customer_service_stats (customer_id, description_id)
+                SELECT DISTINCT NEW.customer_id, description_id FROM invoice_lines WHERE invoice_id = NEW.id;
+            UPDATE customer_service_stats SET uses = uses + (
+                SELECT COUNT(*) FROM invoice_lines
+                WHERE invoice_id = NEW.id AND description_id = customer_service_stats.description_id)
+            WHERE customer_id = NEW.customer_id
+              AND description_id IN (SELECT description_id FROM invoice_lines WHERE invoice_id = NEW.id);
+        END
+    ''')
+    if not exists:
+        _rebuild_customer_stats(cursor)
+
+def _rebuild_customer_stats(conn):
+    conn.execute('DELETE FROM customer_stats')
+    conn.execute('DELETE FROM customer_service_stats')
+    conn.execute('''
+        INSERT INTO customer_stats (customer_id, invoice_count, net_revenue, gross_revenue, first_visit, last_visit)
+        SELECT customer_id, COUNT(*), SUM(subtotal - rabatt), SUM(total), MIN(date), MAX(date)
+        FROM invoices GROUP BY customer_id
+    ''')
+    conn.execute('''
+        INSERT INTO customer_service_stats (customer_id, description_id, uses)
+        SELECT i.customer_id, l.description_id, COUNT(*)
+        FROM invoice_lines l JOIN invoices i ON i.id = l.invoice_id
+        GROUP BY i.customer_id, l.description_id
+    ''')
+
+def rebuild_customer_stats():
+    """Recompute all customer aggregates from the invoices"""
+    run_write(_rebuild_customer_stats)
 
 def get_db_connection():
-    conn = sqlite3.connect(DATABASE_NAME)
+    conn = sqlite3.connect(DATABASE_NAME, timeout=BUSY_TIMEOUT)
     conn.row_factory = sqlite3.Row  # This allows accessing columns by name
     return conn
 
+def _write(sql, params=()):
+    """Run one mutation through the single writer and return its lastrowid"""
+    return get_writer(DATABASE_NAME).execute(lambda conn: conn.execute(sql, params).lastrowid)
+
+def run_write(func, *args):
+    """Run func(conn, *args) as one atomic unit on the writer connection and return its result"""
+    return get_writer(DATABASE_NAME).execute(func, *args)
+
+def _upsert_customer(conn, name, kfz, tel):
+    # Resolves a known plate to its vehicle and customer in this one statement
+    vehicle_id, customer_id = conn.execute('''
+        INSERT INTO vehicles (customer_id, kfz, kfz_normalized) VALUES (NULL, ?, ?)
+        ON CONFLICT (kfz_normalized) DO UPDATE SET kfz = vehicles.kfz
+        RETURNING id, customer_id
+    ''', (kfz, normalize_kfz(kfz))).fetchone()
+    if customer_id is None:
+        customer_id = conn.execute('INSERT INTO customers (name, kfz, tel) VALUES (?, ?, ?) RETURNING id',
+                                   (name, kfz, tel)).fetchone()[0]
+        conn.execute('UPDATE vehicles SET customer_id = ? WHERE id = ?', (customer_id, vehicle_id))
+    return customer_id, vehicle_id
+
+def upsert_customer(name, kfz, tel=None):
+    """Return (customer_id, vehicle_id) for a plate, creating customer and vehicle if the plate is new"""
+    return run_write(_upsert_customer, name, kfz, tel)
+
 def insert_customer(name, kfz, tel=None):
+    return upsert_customer(name, kfz, tel)[0]
+
+def add_vehicle(customer_id, kfz):
+    return _write('INSERT INTO vehicles (customer_id, kfz, kfz_normalized) VALUES (?, ?, ?)',
+                  (customer_id, kfz, normalize_kfz(kfz)))
+
+def get_vehicles_by_customer(customer_id):
     conn = get_db_connection()
-    cursor = conn.cursor()
-    cursor.execute('INSERT INTO customers (name, kfz, tel) VALUES (?, ?, ?)', (name, kfz, tel))
-    conn.commit()
-    customer_id = cursor.lastrowid
+    vehicles = conn.execute('SELECT * FROM vehicles WHERE customer_id = ? ORDER BY id', (customer_id,)).fetchall()
     conn.close()
-    return customer_id
+    return vehicles
 
 def get_customer_by_kfz(kfz):
     conn = get_db_connection()
-    customer = conn.execute('SELECT * FROM customers WHERE kfz = ?', (kfz,)).fetchone()
+    customer = conn.execute('SELECT c.* FROM vehicles v JOIN customers c ON c.id = v.customer_id '
+                            'WHERE v.kfz_normalized = ?', (normalize_kfz(kfz),)).fetchone()
+    conn.close()
+    return customer
+
+def get_customer_by_id(customer_id):
+    conn = get_db_connection()
+    customer = conn.execute('SELECT * FROM customers WHERE id = ?', (customer_id,)).fetchone()
     conn.close()
     return customer
 
+def update_customer_email(customer_id, email):
+    _write('UPDATE customers SET email = ? WHERE id = ?', (email, customer_id))
+
+def get_customer_stats(customer_id):
+    conn = get_db_connection()
+    stats = conn.execute('SELECT * FROM customer_stats WHERE customer_id = ?', (customer_id,)).fetchone()
+    conn.close()
+    return stats
+
+def get_top_services(customer_id, limit=3):
+    conn = get_db_connection()
+    services = conn.execute('SELECT d.text AS service_name, s.uses FROM customer_service_stats s '
+                            'JOIN item_descriptions d ON d.id = s.description_id '
+                            'WHERE s.customer_id = ? AND s.uses > 0 ORDER BY s.uses DESC LIMIT ?',
+                            (customer_id, limit)).fetchall()
+    conn.close()
+    return services
+
+def is_stammkunde(customer_id):
+    """Whether the customer qualifies for the Stammkundenrabatt"""
+    stats = get_customer_stats(customer_id)
+    return stats is not None and stats['invoice_count'] >= config.STAMMKUNDE_MIN_INVOICES
+
+def search_customers(query, limit=20):
+    conn = get_db_connection()
+    pattern = f"%{query}%"
+    # Plates are compared without separators so partial input like "AB 1" still finds "K-AB1"
+    plate = ''.join(c for c in query.upper() if c.isalnum())
+    customers = conn.execute('SELECT * FROM customers WHERE name LIKE ? OR id IN '
+                             "(SELECT customer_id FROM vehicles WHERE REPLACE(kfz_normalized, '-', '') LIKE ?) "
+                             'ORDER BY name LIMIT ?',
+                             (pattern, f"%{plate}%" if plate else pattern, limit)).fetchall()
+    conn.close()
+    return customers
+
 def get_all_customers():
     conn = get_db_connection()
     customers = conn.execute('SELECT * FROM customers').fetchall()
@@ -76,13 +453,7 @@ def get_all_customers():
     return customers
 
 def insert_service(name, standard_price):
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    cursor.execute('INSERT INTO services (name, standard_price) VALUES (?, ?)', (name, standard_price))
-    conn.commit()
-    service_id = cursor.lastrowid
-    conn.close()
-    return service_id
+    return _write('INSERT INTO services (name, standard_price) VALUES (?, ?)', (name, standard_price))
 
 def get_all_services():
     conn = get_db_connection()
@@ -97,28 +468,14 @@ def get_service_by_name(name):
     return service
 
 def update_service(service_id, name, standard_price):
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    cursor.execute('UPDATE services SET name = ?, standard_price = ? WHERE id = ?', (name, standard_price, service_id))
-    conn.commit()
-    conn.close()
+    _write('UPDATE services SET name = ?, standard_price = ? WHERE id = ?', (name, standard_price, service_id))
 
 def delete_service(service_id):
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    cursor.execute('DELETE FROM services WHERE id = ?', (service_id,))
-    conn.commit()
-    conn.close()
+    _write('DELETE FROM services WHERE id = ?', (service_id,))
 
 def insert_invoice(nr, date, customer_id, subtotal, rabatt, mwst, total, zahlart):
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    cursor.execute('INSERT INTO invoices (nr, date, customer_id, subtotal, rabatt, mwst, total, zahlart) VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
-                   (nr, date, customer_id, subtotal, rabatt, mwst, total, zahlart))
-    conn.commit()
-    invoice_id = cursor.lastrowid
-    conn.close()
-    return invoice_id
+    return _write('INSERT INTO invoices (nr, date, customer_id, subtotal, rabatt, mwst, total, zahlart) VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                  (nr, date, customer_id, subtotal, rabatt, mwst, total, zahlart))
 
 def get_latest_invoice_number():
     conn = get_db_connection()
@@ -129,12 +486,52 @@ def get_latest_invoice_number():
     return None
 
 def insert_invoice_item(invoice_id, service_name, qty, unit_price, line_total):
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    cursor.execute('INSERT INTO invoice_items (invoice_id, service_name, qty, unit_price, line_total) VALUES (?, ?, ?, ?, ?)',
-                   (invoice_id, service_name, qty, unit_price, line_total))
-    conn.commit()
-    conn.close()
+    _write('INSERT INTO invoice_items (invoice_id, service_name, qty, unit_price, line_total) VALUES (?, ?, ?, ?, ?)',
+           (invoice_id, service_name, qty, unit_price, line_total))
+
+def _next_invoice_number(conn):
+    year = datetime.now().year
+    latest = conn.execute('SELECT nr FROM invoices ORDER BY id DESC LIMIT 1').fetchone()
+    if latest:
+        last_number = int(latest['nr'].split("-")[1])
+        return f"{year}-{last_number + 1:04d}"
+    return f"{year}-1001"
+
+def _create_invoice(conn, customer_name, kfz, tel, items, rabatt, zahlart, date, email=None):
+    customer_id, vehicle_id = _upsert_customer(conn, customer_name, kfz, tel)
+    if email:
+        conn.execute('UPDATE customers SET email = ? WHERE id = ?', (email, customer_id))
+
+    subtotal = sum(item['qty'] * item['unit_price'] for item in items)
+    mwst = (subtotal - rabatt) * config.VAT_RATE
+    total = subtotal - rabatt + mwst
+    nr = _next_invoice_number(conn)
+    invoice_id = conn.execute('INSERT INTO invoices (nr, date, customer_id, vehicle_id, subtotal, rabatt, mwst, total, zahlart) '
+                              'VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                              (nr, date, customer_id, vehicle_id, subtotal, rabatt, mwst, total, zahlart)).lastrowid
+    conn.executemany('INSERT INTO invoice_items (invoice_id, service_name, qty, unit_price, line_total) VALUES (?, ?, ?, ?, ?)',
+                     [(invoice_id, item['service_name'], item['qty'], item['unit_price'], item['qty'] * item['unit_price'])
+                      for item in items])
+    return invoice_id, nr
+
+def submit_create_invoice(customer_name, kfz, tel, items, rabatt, zahlart, date=None, email=None):
+    """
+    Queue saving customer (if new), invoice and items as one transaction
+
+    items is a list of dicts with service_name, qty and unit_price. The
+    invoice number is assigned inside the same transaction, so concurrent
+    sessions never get the same number. A given email is stored on the
+    customer for mail_delivery.py.
+
+    Returns:
+        Future with (invoice_id, invoice_nr)
+    """
+    date = date or datetime.now().strftime("%Y-%m-%d")
+    return get_writer(DATABASE_NAME).submit(_create_invoice, customer_name, kfz, tel, items, rabatt, zahlart, date, email)
+
+def create_invoice(customer_name, kfz, tel, items, rabatt, zahlart, date=None, email=None):
+    """Save an invoice like submit_create_invoice and wait for it; returns (invoice_id, invoice_nr)"""
+    return submit_create_invoice(customer_name, kfz, tel, items, rabatt, zahlart, date, email).result()
 
 def get_invoice_details(invoice_id):
     conn = get_db_connection()
@@ -143,12 +540,80 @@ def get_invoice_details(invoice_id):
     conn.close()
     return invoice, items
 
+def iter_invoice_rows(customer_id=None, date_from=None, date_to=None):
+    """Yield (invoice, customer, items) per invoice, streamed from a single cursor"""
+    conn = get_db_connection()
+    try:
+        query = '''
+            SELECT i.*, c.name AS customer_name, c.kfz AS customer_kfz, c.tel AS customer_tel,
+                   c.email AS customer_email, it.id AS item_id, it.service_name, it.qty,
+                   it.unit_price, it.line_total
+            FROM invoices i
+            JOIN customers c ON c.id = i.customer_id
+            LEFT JOIN invoice_items it ON it.invoice_id = i.id
+            WHERE (? IS NULL OR i.customer_id = ?)
+              AND (? IS NULL OR i.date >= ?)
+              AND (? IS NULL OR i.date <= ?)
+            ORDER BY i.id, it.id
+        '''
+        rows = conn.execute(query, (customer_id, customer_id, date_from, date_from, date_to, date_to))
+        current = None
+        for row in rows:
+            if current is None or current[0]['id'] != row['id']:
+                if current is not None:
+                    yield current
+                customer = {'id': row['customer_id'], 'name': row['customer_name'], 'kfz': row['customer_kfz'],
+                            'tel': row['customer_tel'], 'email': row['customer_email']}
+                current = (row, customer, [])
+            if row['item_id'] is not None:
+                current[2].append(row)
+        if current is not None:
+            yield current
+    finally:
+        conn.close()
+
+def get_service_report(date_from=None, date_to=None):
+    """Bookings and net revenue per catalogue service, grouped on the integer service id"""
+    conn = get_db_connection()
+    report = conn.execute('''
+        SELECT s.id AS service_id, s.name, COUNT(*) AS bookings, SUM(l.qty) AS qty, SUM(l.line_total) AS revenue
+        FROM invoice_lines l
+        JOIN invoices i ON i.id = l.invoice_id
+        JOIN services s ON s.id = l.service_id
+        WHERE (? IS NULL OR i.date >= ?) AND (? IS NULL OR i.date <= ?)
+        GROUP BY l.service_id
+        ORDER BY revenue DESC
+    ''', (date_from, date_from, date_to, date_to)).fetchall()
+    conn.close()
+    return report
+
 def get_invoices_by_customer(customer_id):
     conn = get_db_connection()
     invoices = conn.execute('SELECT * FROM invoices WHERE customer_id = ? ORDER BY date DESC', (customer_id,)).fetchall()
     conn.close()
     return invoices
 
+def record_invoice_delivery(invoice_id, recipient, status, attempts, error=None):
+    _write('INSERT OR REPLACE INTO invoice_deliveries (invoice_id, recipient, status, attempts, error, updated_at) '
+           "VALUES (?, ?, ?, ?, ?, datetime('now'))",
+           (invoice_id, recipient, status, attempts, error))
+
+def get_invoice_delivery(invoice_id):
+    conn = get_db_connection()
+    delivery = conn.execute('SELECT * FROM invoice_deliveries WHERE invoice_id = ?', (invoice_id,)).fetchone()
+    conn.close()
+    return delivery
+
+def get_invoice_deliveries(status=None):
+    conn = get_db_connection()
+    if status is None:
+        deliveries = conn.execute('SELECT * FROM invoice_deliveries ORDER BY updated_at DESC').fetchall()
+    else:
+        deliveries = conn.execute('SELECT * FROM invoice_deliveries WHERE status = ? ORDER BY updated_at DESC',
+                                  (status,)).fetchall()
+    conn.close()
+    return deliveries
+
 
 if __name__ == '__main__':
     init_db()
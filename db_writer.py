@@ -0,0 +1,173 @@
+"""
+Single-writer queue for glanzwerk.db
+
+SQLite allows one writer at a time. Instead of every Streamlit session
+opening its own connection and committing on its own, all mutations are
+queued to one writer thread per process. The writer drains whatever has
+queued up, runs it inside a single BEGIN IMMEDIATE ... COMMIT (a group
+commit) and hands each caller its result through a Future. Each job runs in
+its own savepoint, so a failing job does not take the rest of the batch
+with it. Readers are unaffected: with WAL they keep reading while the writer
+commits.
+"""
+
+import atexit
+import queue
+import sqlite3
+import threading
+import time
+from concurrent.futures import Future
+
+_STOP = object()
+
+
+class WriteQueue:
+    def __init__(self, database, max_batch=200, timeout=30, begin_retries=5):
+        self.database = database
+        self.max_batch = max_batch
+        self.timeout = timeout
+        self.begin_retries = begin_retries
+        self._queue = queue.Queue()
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def _ensure_started(self):
+        if self._thread is None or not self._thread.is_alive():
+            with self._lock:
+                if self._thread is None or not self._thread.is_alive():
+                    self._thread = threading.Thread(target=self._run, name="glanzwerk-db-writer", daemon=True)
+                    self._thread.start()
+
+    def submit(self, func, *args):
+        """
+        Queue a write; func(conn, *args) runs on the writer connection
+
+        Returns:
+            Future with the return value of func, or its exception
+        """
+        future = Future()
+        self._ensure_started()
+        self._queue.put((func, args, future))
+        return future
+
+    def execute(self, func, *args):
+        """Queue a write and wait until it is committed"""
+        return self.submit(func, *args).result()
+
+    def close(self):
+        """Commit everything queued so far and stop the writer thread"""
+        if self._thread is not None and self._thread.is_alive():
+            self._queue.put(_STOP)
+            self._thread.join()
+
+    def _run(self):
+        # isolation_level=None: transactions are controlled explicitly below
+        conn = sqlite3.connect(self.database, timeout=self.timeout, isolation_level=None)
+        conn.row_factory = sqlite3.Row
+        try:
+            while True:
+                batch = [self._queue.get()]
+                while len(batch) < self.max_batch:
+                    try:
+                        batch.append(self._queue.get_nowait())
+                    except queue.Empty:
+                        break
+                stop = _STOP in batch
+                jobs = [job for job in batch if job is not _STOP]
+                if jobs:
+                    self._commit_batch(conn, jobs)
+                if stop:
+                    break
+        finally:
+            conn.close()
+
+    def _begin(self, conn):
+        # The connection timeout already waits for other processes; retry a few
+        # more times before giving up on the batch
+        for attempt in range(self.begin_retries):
+            try:
+                conn.execute("BEGIN IMMEDIATE")
+                return
+            except sqlite3.OperationalError as e:
+                if "locked" not in str(e) or attempt == self.begin_retries - 1:
+                    raise
+                time.sleep(0.05 * 2 ** attempt)
+
+    def _commit_batch(self, conn, jobs):
+        # Jobs whose caller already cancelled the future are not run at all
+        jobs = [job for job in jobs if job[2].set_running_or_notify_cancel()]
+        if not jobs:
+            return
+        try:
+            self._run_batch(conn, jobs)
+        except BaseException as e:
+            # Anything outside a job's own error handling (a failing SAVEPOINT,
+            # a job that committed on its own, KeyboardInterrupt, ...) fails the
+            # whole batch, but must neither kill the writer nor leave callers waiting
+            try:
+                if conn.in_transaction:
+                    conn.execute("ROLLBACK")
+            except sqlite3.Error:
+                pass
+            for _, _, future in jobs:
+                if not future.done():
+                    future.set_exception(e)
+
+    def _run_batch(self, conn, jobs):
+        try:
+            self._begin(conn)
+        except sqlite3.Error as e:
+            for _, _, future in jobs:
+                future.set_exception(e)
+            return
+
+        outcomes = []
+        for func, args, future in jobs:
+            conn.execute("SAVEPOINT job")
+            try:
+                result = func(conn, *args)
+            except Exception as e:
+                conn.execute("ROLLBACK TO job")
+                conn.execute("RELEASE job")
+                outcomes.append((future, None, e))
+            else:
+                if not conn.in_transaction:
+                    # The job committed or rolled back itself; earlier jobs of the
+                    # batch may be committed already, but are reported as failed
+                    raise sqlite3.ProgrammingError(f"{func.__name__} ended the writer transaction")
+                conn.execute("RELEASE job")
+                outcomes.append((future, result, None))
+
+        try:
+            conn.execute("COMMIT")
+        except sqlite3.Error as e:
+            if conn.in_transaction:
+                conn.execute("ROLLBACK")
+            for future, _, _ in outcomes:
+                future.set_exception(e)
+            return
+
+        for future, result, error in outcomes:
+            if error is None:
+                future.set_result(result)
+            else:
+                future.set_exception(error)
+
+
+_writers = {}
+_writers_lock = threading.Lock()
+
+
+def get_writer(database):
+    """Return the process-wide writer for a database file"""
+    with _writers_lock:
+        writer = _writers.get(database)
+        if writer is None:
+            writer = _writers[database] = WriteQueue(database)
+        return writer
+
+
+@atexit.register
+def _close_writers():
+    for writer in list(_writers.values()):
+        writer.close()
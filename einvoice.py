@@ -0,0 +1,366 @@
+#!/usr/bin/env python3
+"""
+EN 16931 (CII) / ZUGFeRD e-invoice generation
+
+Writes invoices as UN/CEFACT Cross Industry Invoice (CII) XML following
+EN 16931. The same CII document is what ZUGFeRD / Factur-X embeds into a
+PDF, so one writer serves both formats.
+
+The documents declare plain EN 16931, not the XRechnung CIUS, and file and
+archive entry names say EN 16931 so they are not routed to an XRechnung
+validator: XRechnung also requires the buyer's postal address (city,
+postcode) and an electronic address, and customers have no address and
+often no e-mail. Once those are collected, _write_buyer can emit them and
+GUIDELINE_ID can switch to
+urn:cen.eu:en16931:2017#compliant#urn:xeinkauf.de:kosit:xrechnung_3.0.
+
+The XML is streamed element by element with XMLGenerator instead of building
+a DOM tree, and bulk exports read invoices from a single database cursor, so
+memory use stays flat no matter how many invoices are exported.
+"""
+
+import argparse
+import io
+import os
+import sys
+import zipfile
+from datetime import datetime, timedelta
+from xml.sax.saxutils import XMLGenerator
+
+import config
+import db
+
+GUIDELINE_ID = "urn:cen.eu:en16931:2017"
+PEPPOL_BILLING_PROCESS = "urn:fdc:peppol.eu:2017:poacc:billing:01:1.0"
+ZUGFERD_FILENAME = "factur-x.xml"
+
+NAMESPACES = {
+    "xmlns:rsm": "urn:un:unece:uncefact:data:standard:CrossIndustryInvoice:100",
+    "xmlns:ram": "urn:un:unece:uncefact:data:standard:ReusableAggregateBusinessInformationEntity:100",
+    "xmlns:udt": "urn:un:unece:uncefact:data:standard:UnqualifiedDataType:100",
+}
+
+# UNTDID 4461 payment means codes for the payment methods offered in app.py
+PAYMENT_MEANS = {
+    "Bar": "10",
+    "Karte": "48",
+    "Überweisung": "58",
+    "PayPal": "68",
+}
+
+
+class _XMLWriter:
+    """Thin wrapper around XMLGenerator for nested element output"""
+
+    def __init__(self, out):
+        self._gen = XMLGenerator(out, encoding="utf-8", short_empty_elements=True)
+
+    def start_document(self):
+        self._gen.startDocument()
+
+    def end_document(self):
+        self._gen.endDocument()
+
+    def start(self, tag, attrs=None):
+        self._gen.startElement(tag, attrs or {})
+
+    def end(self, tag):
+        self._gen.endElement(tag)
+
+    def element(self, tag, text, attrs=None):
+        self._gen.startElement(tag, attrs or {})
+        self._gen.characters(str(text))
+        self._gen.endElement(tag)
+
+
+def _amount(value):
+    return f"{value:.2f}"
+
+
+def _cii_date(iso_date):
+    return datetime.strptime(iso_date, "%Y-%m-%d").strftime("%Y%m%d")
+
+
+def _write_date(w, tag, iso_date):
+    w.start(tag)
+    w.element("udt:DateTimeString", _cii_date(iso_date), {"format": "102"})
+    w.end(tag)
+
+
+def _write_vat(w, tag, basis=None, tax=None):
+    """Standard-rated VAT block, used per line and for the header breakdown"""
+    w.start(tag)
+    if tax is not None:
+        w.element("ram:CalculatedAmount", _amount(tax))
+    w.element("ram:TypeCode", "VAT")
+    if basis is not None:
+        w.element("ram:BasisAmount", _amount(basis))
+    w.element("ram:CategoryCode", "S")
+    w.element("ram:RateApplicablePercent", f"{config.VAT_RATE * 100:.2f}")
+    w.end(tag)
+
+
+def _write_seller(w):
+    w.start("ram:SellerTradeParty")
+    w.element("ram:Name", config.COMPANY_NAME)
+    w.start("ram:DefinedTradeContact")
+    w.element("ram:PersonName", config.COMPANY_NAME)
+    w.start("ram:TelephoneUniversalCommunication")
+    w.element("ram:CompleteNumber", config.COMPANY_PHONE)
+    w.end("ram:TelephoneUniversalCommunication")
+    w.start("ram:EmailURIUniversalCommunication")
+    w.element("ram:URIID", config.COMPANY_EMAIL)
+    w.end("ram:EmailURIUniversalCommunication")
+    w.end("ram:DefinedTradeContact")
+    w.start("ram:PostalTradeAddress")
+    w.element("ram:PostcodeCode", config.COMPANY_POSTCODE)
+    w.element("ram:LineOne", config.COMPANY_STREET)
+    w.element("ram:CityName", config.COMPANY_CITY)
+    w.element("ram:CountryID", config.COMPANY_COUNTRY)
+    w.end("ram:PostalTradeAddress")
+    w.start("ram:URIUniversalCommunication")
+    w.element("ram:URIID", config.COMPANY_EMAIL, {"schemeID": "EM"})
+    w.end("ram:URIUniversalCommunication")
+    w.start("ram:SpecifiedTaxRegistration")
+    w.element("ram:ID", config.COMPANY_VAT_ID, {"schemeID": "VA"})
+    w.end("ram:SpecifiedTaxRegistration")
+    w.end("ram:SellerTradeParty")
+
+
+def _write_buyer(w, customer):
+    w.start("ram:BuyerTradeParty")
+    w.element("ram:Name", customer["name"])
+    w.start("ram:PostalTradeAddress")
+    w.element("ram:CountryID", config.COMPANY_COUNTRY)
+    w.end("ram:PostalTradeAddress")
+    if customer["email"]:
+        w.start("ram:URIUniversalCommunication")
+        w.element("ram:URIID", customer["email"], {"schemeID": "EM"})
+        w.end("ram:URIUniversalCommunication")
+    w.end("ram:BuyerTradeParty")
+
+
+def _write_line(w, position, item):
+    w.start("ram:IncludedSupplyChainTradeLineItem")
+    w.start("ram:AssociatedDocumentLineDocument")
+    w.element("ram:LineID", position)
+    w.end("ram:AssociatedDocumentLineDocument")
+    w.start("ram:SpecifiedTradeProduct")
+    w.element("ram:Name", item["service_name"])
+    w.end("ram:SpecifiedTradeProduct")
+    w.start("ram:SpecifiedLineTradeAgreement")
+    w.start("ram:NetPriceProductTradePrice")
+    w.element("ram:ChargeAmount", _amount(item["unit_price"]))
+    w.end("ram:NetPriceProductTradePrice")
+    w.end("ram:SpecifiedLineTradeAgreement")
+    w.start("ram:SpecifiedLineTradeDelivery")
+    w.element("ram:BilledQuantity", f"{item['qty']:g}", {"unitCode": "C62"})
+    w.end("ram:SpecifiedLineTradeDelivery")
+    w.start("ram:SpecifiedLineTradeSettlement")
+    _write_vat(w, "ram:ApplicableTradeTax")
+    w.start("ram:SpecifiedTradeSettlementLineMonetarySummation")
+    w.element("ram:LineTotalAmount", _amount(item["line_total"]))
+    w.end("ram:SpecifiedTradeSettlementLineMonetarySummation")
+    w.end("ram:SpecifiedLineTradeSettlement")
+    w.end("ram:IncludedSupplyChainTradeLineItem")
+
+
+def _write_settlement(w, invoice, items):
+    line_total = sum(item["line_total"] for item in items)
+    tax_basis = line_total - invoice["rabatt"]
+    due_date = datetime.strptime(invoice["date"], "%Y-%m-%d") + timedelta(days=config.PAYMENT_TERM_DAYS)
+
+    w.start("ram:ApplicableHeaderTradeSettlement")
+    w.element("ram:InvoiceCurrencyCode", "EUR")
+    w.start("ram:SpecifiedTradeSettlementPaymentMeans")
+    payment_code = PAYMENT_MEANS.get(invoice["zahlart"], "1")
+    w.element("ram:TypeCode", payment_code)
+    w.element("ram:Information", invoice["zahlart"])
+    if payment_code == "58":
+        w.start("ram:PayeePartyCreditorFinancialAccount")
+        w.element("ram:IBANID", config.IBAN.replace(" ", ""))
+        w.end("ram:PayeePartyCreditorFinancialAccount")
+    w.end("ram:SpecifiedTradeSettlementPaymentMeans")
+    _write_vat(w, "ram:ApplicableTradeTax", basis=tax_basis, tax=invoice["mwst"])
+    if invoice["rabatt"]:
+        w.start("ram:SpecifiedTradeAllowanceCharge")
+        w.start("ram:ChargeIndicator")
+        w.element("udt:Indicator", "false")
+        w.end("ram:ChargeIndicator")
+        w.element("ram:ActualAmount", _amount(invoice["rabatt"]))
+        w.element("ram:Reason", "Rabatt")
+        _write_vat(w, "ram:CategoryTradeTax")
+        w.end("ram:SpecifiedTradeAllowanceCharge")
+    w.start("ram:SpecifiedTradePaymentTerms")
+    w.element("ram:Description", f"Zahlbar bis {due_date.strftime('%d.%m.%Y')}")
+    _write_date(w, "ram:DueDateDateTime", due_date.strftime("%Y-%m-%d"))
+    w.end("ram:SpecifiedTradePaymentTerms")
+    w.start("ram:SpecifiedTradeSettlementHeaderMonetarySummation")
+    w.element("ram:LineTotalAmount", _amount(line_total))
+    w.element("ram:AllowanceTotalAmount", _amount(invoice["rabatt"]))
+    w.element("ram:TaxBasisTotalAmount", _amount(tax_basis))
+    w.element("ram:TaxTotalAmount", _amount(invoice["mwst"]), {"currencyID": "EUR"})
+    w.element("ram:GrandTotalAmount", _amount(invoice["total"]))
+    w.element("ram:DuePayableAmount", _amount(invoice["total"]))
+    w.end("ram:SpecifiedTradeSettlementHeaderMonetarySummation")
+    w.end("ram:ApplicableHeaderTradeSettlement")
+
+
+def write_cii_invoice(out, invoice, customer, items):
+    """
+    Write one invoice as EN 16931 CII XML
+
+    Args:
+        out: Binary file-like object to write to
+        invoice: Row from the invoices table
+        customer: Row (or dict) from the customers table
+        items: Rows from the invoice_items table
+    """
+    w = _XMLWriter(out)
+    w.start_document()
+    w.start("rsm:CrossIndustryInvoice", NAMESPACES)
+
+    w.start("rsm:ExchangedDocumentContext")
+    w.start("ram:BusinessProcessSpecifiedDocumentContextParameter")
+    w.element("ram:ID", PEPPOL_BILLING_PROCESS)
+    w.end("ram:BusinessProcessSpecifiedDocumentContextParameter")
+    w.start("ram:GuidelineSpecifiedDocumentContextParameter")
+    w.element("ram:ID", GUIDELINE_ID)
+    w.end("ram:GuidelineSpecifiedDocumentContextParameter")
+    w.end("rsm:ExchangedDocumentContext")
+
+    w.start("rsm:ExchangedDocument")
+    w.element("ram:ID", invoice["nr"])
+    w.element("ram:TypeCode", "380")
+    _write_date(w, "ram:IssueDateTime", invoice["date"])
+    w.end("rsm:ExchangedDocument")
+
+    w.start("rsm:SupplyChainTradeTransaction")
+    for position, item in enumerate(items, start=1):
+        _write_line(w, position, item)
+
+    w.start("ram:ApplicableHeaderTradeAgreement")
+    # The licence plate is the reference our customers know their invoices by
+    w.element("ram:BuyerReference", customer["kfz"])
+    _write_seller(w)
+    _write_buyer(w, customer)
+    w.end("ram:ApplicableHeaderTradeAgreement")
+
+    w.start("ram:ApplicableHeaderTradeDelivery")
+    w.start("ram:ActualDeliverySupplyChainEvent")
+    _write_date(w, "ram:OccurrenceDateTime", invoice["date"])
+    w.end("ram:ActualDeliverySupplyChainEvent")
+    w.end("ram:ApplicableHeaderTradeDelivery")
+
+    _write_settlement(w, invoice, items)
+    w.end("rsm:SupplyChainTradeTransaction")
+
+    w.end("rsm:CrossIndustryInvoice")
+    w.end_document()
+
+
+def export_invoice(invoice_id, output_path):
+    """Write a single invoice from the database as EN 16931 CII XML"""
+    invoice, items = db.get_invoice_details(invoice_id)
+    if invoice is None:
+        raise ValueError(f"Rechnung {invoice_id} nicht gefunden")
+    customer = db.get_customer_by_id(invoice["customer_id"])
+    with open(output_path, "wb") as xml_file:
+        write_cii_invoice(xml_file, invoice, customer, items)
+
+
+def export_bulk(output_path, customer_id=None, date_from=None, date_to=None):
+    """
+    Export many invoices into a ZIP archive, one EN 16931 CII XML per invoice
+
+    Invoices are read from one streaming cursor and only one XML is held in
+    memory at a time, so memory stays constant for any number of invoices.
+    An invoice that cannot be exported is skipped and reported; the archive
+    is written to a temporary file and only renamed to output_path once it
+    is complete.
+
+    Returns:
+        Tuple (number of exported invoices, list of (invoice nr, error))
+    """
+    count = 0
+    failed = []
+    partial_path = output_path + ".part"
+    try:
+        with zipfile.ZipFile(partial_path, "w", compression=zipfile.ZIP_DEFLATED) as archive:
+            for invoice, customer, items in db.iter_invoice_rows(customer_id, date_from, date_to):
+                xml_buffer = io.BytesIO()
+                try:
+                    write_cii_invoice(xml_buffer, invoice, customer, items)
+                except Exception as e:
+                    failed.append((invoice["nr"], str(e)))
+                    continue
+                archive.writestr(f"EN16931_{invoice['nr']}.xml", xml_buffer.getvalue())
+                count += 1
+        os.replace(partial_path, output_path)
+    finally:
+        if os.path.exists(partial_path):
+            os.remove(partial_path)
+    return count, failed
+
+
+def embed_zugferd(pdf_path, xml_path, output_path=None):
+    """
+    Attach the CII XML to an existing invoice PDF as factur-x.xml (ZUGFeRD)
+
+    Requires the optional pypdf package. The attachment makes the PDF
+    machine-readable for ZUGFeRD-aware receivers; full PDF/A-3 conformance
+    additionally depends on how the PDF itself was produced.
+    """
+    try:
+        from pypdf import PdfWriter
+    except ImportError:
+        raise RuntimeError("ZUGFeRD embedding requires pypdf: pip install pypdf")
+
+    writer = PdfWriter(clone_from=pdf_path)
+    with open(xml_path, "rb") as xml_file:
+        writer.add_attachment(ZUGFERD_FILENAME, xml_file.read())
+    writer.add_metadata({"/Subject": "ZUGFeRD / Factur-X invoice"})
+    with open(output_path or pdf_path, "wb") as pdf_file:
+        writer.write(pdf_file)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="EN 16931 (CII) / ZUGFeRD Export")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    single = subparsers.add_parser("invoice", help="Eine Rechnung als XML exportieren")
+    single.add_argument("invoice_id", type=int)
+    single.add_argument("output")
+    single.add_argument("--pdf", help="PDF, in das die XML als ZUGFeRD eingebettet wird")
+
+    bulk = subparsers.add_parser("bulk", help="Viele Rechnungen als ZIP exportieren")
+    bulk.add_argument("output")
+    bulk.add_argument("--kfz", help="Nur Rechnungen dieses Kunden")
+    bulk.add_argument("--from", dest="date_from", help="Ab Datum (YYYY-MM-DD)")
+    bulk.add_argument("--to", dest="date_to", help="Bis Datum (YYYY-MM-DD)")
+
+    args = parser.parse_args()
+    db.init_db()
+
+    if args.command == "invoice":
+        export_invoice(args.invoice_id, args.output)
+        if args.pdf:
+            embed_zugferd(args.pdf, args.output)
+        print(f"✅ EN-16931-Rechnung (CII) erstellt: {args.output}")
+    else:
+        customer_id = None
+        if args.kfz:
+            customer = db.get_customer_by_kfz(args.kfz)
+            if customer is None:
+                print(f"❌ Kein Kunde mit KFZ {args.kfz}")
+                return 1
+            customer_id = customer["id"]
+        count, failed = export_bulk(args.output, customer_id, args.date_from, args.date_to)
+        print(f"✅ {count} Rechnungen exportiert: {args.output}")
+        for nr, error in failed:
+            print(f"⚠️ Rechnung {nr} übersprungen: {error}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
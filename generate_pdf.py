@@ -4,11 +4,15 @@ PDF Generator for Professional Invoice
 Converts HTML invoice template to PDF format
 """
 
-import weasyprint
 from datetime import datetime, timedelta
+import html
 import os
 
-def generate_invoice_pdf(
+import config
+
+TEMPLATE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "invoice_template.html")
+
+def build_invoice_html(
     customer_name="[Kundenname]",
     customer_address="[Kundenadresse]", 
     customer_city="[Stadt, PLZ]",
@@ -19,11 +23,10 @@ def generate_invoice_pdf(
     services=None,
     bank_name="[Bankname]",
     iban="[IBAN-Nummer]",
-    bic="[BIC-Code]",
-    output_path="professional_invoice.pdf"
+    bic="[BIC-Code]"
 ):
     """
-    Generate a professional PDF invoice
+    Fill the HTML invoice template and return the HTML string
     
     Args:
         customer_name: Name of the customer
@@ -37,7 +40,6 @@ def generate_invoice_pdf(
         bank_name: Bank name
         iban: IBAN number
         bic: BIC code
-        output_path: Output PDF file path
     """
     
     # Set default dates
@@ -52,6 +54,7 @@ def generate_invoice_pdf(
         service_period = datetime.now().strftime("%m/%Y")
     
     # Default services if none provided
+    custom_services = services is not None
     if services is None:
         services = [
             {
@@ -71,8 +74,7 @@ def generate_invoice_pdf(
         ]
     
     # Read the HTML template
-    template_path = "/home/ubuntu/invoice_project/invoice_template.html"
-    with open(template_path, 'r', encoding='utf-8') as file:
+    with open(TEMPLATE_PATH, 'r', encoding='utf-8') as file:
         html_content = file.read()
     
     # Replace placeholders with actual data
@@ -88,7 +90,7 @@ def generate_invoice_pdf(
     html_content = html_content.replace("[BIC-Code]", bic)
     
     # Generate services table rows if custom services provided
-    if len(services) != 2:  # If not default services
+    if custom_services:
         services_html = ""
         total_net = 0
         total_tax = 0
@@ -106,8 +108,9 @@ def generate_invoice_pdf(
             
             # Calculate totals (assuming Euro format)
             try:
-                net_amount = float(service['unit_price'].replace('€', '').replace(',', '.').strip())
+                # The net line amount is the gross line total minus its tax, so quantities count
                 tax_amount = float(service['tax'].replace('€', '').replace(',', '.').strip())
+                net_amount = float(service['total'].replace('€', '').replace(',', '.').strip()) - tax_amount
                 total_net += net_amount
                 total_tax += tax_amount
             except:
@@ -124,18 +127,109 @@ def generate_invoice_pdf(
             html_content = html_content.replace("219,00 €", f"{total_net:.2f} €".replace('.', ','))
             html_content = html_content.replace("41,61 €", f"{total_tax:.2f} €".replace('.', ','))
             html_content = html_content.replace("260,61 €", f"{total_gross:.2f} €".replace('.', ','))
+
+    return html_content
+
+def _euro(amount):
+    return f"{amount:.2f} €".replace('.', ',')
+
+def build_invoice_html_from_db(invoice, customer, items):
+    """
+    Fill the HTML invoice template from database rows
+
+    Args:
+        invoice: Row from the invoices table
+        customer: Row from the customers table
+        items: Rows from the invoice_items table
+
+    Returns:
+        HTML string for write_pdf_bytes or RendererPool.render
+    """
+    invoice_date = datetime.strptime(invoice['date'], "%Y-%m-%d")
+    services = [{
+        "description": html.escape(item['service_name']),
+        "quantity": f"{item['qty']:g}",
+        "unit_price": _euro(item['unit_price']),
+        "tax": _euro(item['line_total'] * config.VAT_RATE),
+        "total": _euro(item['line_total'] * (1 + config.VAT_RATE)),
+    } for item in items]
+    if invoice['rabatt']:
+        services.append({
+            "description": "Rabatt",
+            "quantity": "1",
+            "unit_price": _euro(-invoice['rabatt']),
+            "tax": _euro(-invoice['rabatt'] * config.VAT_RATE),
+            "total": _euro(-invoice['rabatt'] * (1 + config.VAT_RATE)),
+        })
+
+    return build_invoice_html(
+        customer_name=html.escape(customer['name']),
+        customer_address=html.escape(f"KFZ: {customer['kfz']}"),
+        customer_city="",
+        invoice_number=invoice['nr'],
+        invoice_date=invoice_date.strftime("%d.%m.%Y"),
+        due_date=(invoice_date + timedelta(days=config.PAYMENT_TERM_DAYS)).strftime("%d.%m.%Y"),
+        service_period=invoice_date.strftime("%m/%Y"),
+        services=services,
+        bank_name=config.BANK_NAME,
+        iban=config.IBAN,
+        bic=config.BIC
+    )
+
+def write_pdf_bytes(html_content, base_url=".", font_config=None, cache=None):
+    """
+    Render HTML to PDF bytes with WeasyPrint
+
+    The in-process path and the workers of pdf_renderer_pool both go through
+    here, so both produce the same document; the workers only pass their warm
+    font configuration and image cache.
+    """
+    # Imported here so that processes using the pool never load WeasyPrint
+    import weasyprint
+
+    html_doc = weasyprint.HTML(string=html_content, base_url=base_url)
+    return html_doc.write_pdf(
+        font_config=font_config,
+        optimize_images=True,
+        cache=cache,
+        pdf_version='1.7'
+    )
+
+def generate_invoice_pdf(
+    customer_name="[Kundenname]",
+    customer_address="[Kundenadresse]", 
+    customer_city="[Stadt, PLZ]",
+    invoice_number="2025-001",
+    invoice_date=None,
+    due_date=None,
+    service_period=None,
+    services=None,
+    bank_name="[Bankname]",
+    iban="[IBAN-Nummer]",
+    bic="[BIC-Code]",
+    output_path="professional_invoice.pdf",
+    renderer_pool=None
+):
+    """
+    Generate a professional PDF invoice
     
+    Args:
+        customer_name ... bic: Invoice fields, see build_invoice_html
+        output_path: Output PDF file path
+        renderer_pool: Optional pdf_renderer_pool.RendererPool with warm WeasyPrint
+            workers; without it WeasyPrint is imported and run in this process
+    """
+    html_content = build_invoice_html(
+        customer_name, customer_address, customer_city, invoice_number, invoice_date,
+        due_date, service_period, services, bank_name, iban, bic
+    )
+
     # Generate PDF
     try:
-        # Create WeasyPrint HTML document
-        html_doc = weasyprint.HTML(string=html_content, base_url=".")
-        
-        # Generate PDF with custom styling
-        pdf_bytes = html_doc.write_pdf(
-            stylesheets=[],
-            optimize_images=True,
-            pdf_version='1.7'
-        )
+        if renderer_pool is not None:
+            pdf_bytes = renderer_pool.render(html_content)
+        else:
+            pdf_bytes = write_pdf_bytes(html_content)
         
         # Write PDF to file
         with open(output_path, 'wb') as pdf_file:
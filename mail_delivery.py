@@ -0,0 +1,287 @@
+#!/usr/bin/env python3
+"""
+Batch delivery of invoice PDFs by e-mail.
+
+Invoices are sent over a small pool of persistent SMTP connections, so a
+month-end run of several hundred invoices only pays for a handful of
+connection handshakes instead of one per mail. PDFs are rendered in worker
+processes and each one is handed to a sender as soon as it is ready. Every attempt is recorded in
+the invoice_deliveries table of glanzwerk.db.
+"""
+
+import argparse
+import multiprocessing
+import os
+import queue
+import smtplib
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+from email.message import EmailMessage
+
+import config
+import db
+from pdf_generator import render_invoice_pdf
+
+STATUS_SENT = 'sent'
+STATUS_FAILED = 'failed'
+STATUS_SKIPPED = 'skipped'
+# Only returned by send_invoices, never recorded, so the 'sent' row stays as it is
+STATUS_ALREADY_SENT = 'already_sent'
+
+# Errors worth retrying on a fresh connection
+TRANSIENT_ERRORS = (smtplib.SMTPServerDisconnected, smtplib.SMTPConnectError, ConnectionError, TimeoutError)
+
+
+def invoice_pdf_filename(invoice, customer):
+    """File name app.py uses when it saves an invoice PDF"""
+    return f"Rechnung_{customer['name'].replace(' ', '_')}_{invoice['nr']}.pdf"
+
+
+def load_invoice_pdf(invoice, customer, items, pdf_dir='.'):
+    """Fetch the PDF previously saved for an invoice, or render it from the database rows"""
+    # app.py names the file after the name typed into the form, which can differ
+    # from the stored customer name, so a missing file is not an error
+    try:
+        with open(os.path.join(pdf_dir, invoice_pdf_filename(invoice, customer)), 'rb') as pdf_file:
+            return pdf_file.read()
+    except FileNotFoundError:
+        return render_invoice_pdf(invoice, customer, items)
+
+
+class SMTPConnectionPool:
+    """Bounded pool of logged-in SMTP connections that are reused across messages"""
+
+    def __init__(self, size=4, host=None, port=None, user=None, password=None, starttls=None, timeout=30):
+        self.host = host or config.SMTP_HOST
+        self.port = port or config.SMTP_PORT
+        self.user = user if user is not None else config.SMTP_USER
+        self.password = password if password is not None else config.SMTP_PASSWORD
+        self.starttls = starttls if starttls is not None else config.SMTP_STARTTLS
+        self.timeout = timeout
+        # Each slot holds either a live connection or None for one not opened yet
+        self._slots = queue.LifoQueue()
+        for _ in range(size):
+            self._slots.put(None)
+
+    def _connect(self):
+        smtp = smtplib.SMTP(self.host, self.port, timeout=self.timeout)
+        smtp.ehlo()
+        if self.starttls:
+            smtp.starttls()
+            smtp.ehlo()
+        if self.user:
+            smtp.login(self.user, self.password)
+        return smtp
+
+    def acquire(self):
+        smtp = self._slots.get()
+        if smtp is None:
+            try:
+                smtp = self._connect()
+            except Exception:
+                self._slots.put(None)
+                raise
+        return smtp
+
+    def release(self, smtp, broken=False):
+        if broken:
+            smtp.close()
+            self._slots.put(None)
+        else:
+            self._slots.put(smtp)
+
+    def send(self, message):
+        smtp = self.acquire()
+        try:
+            smtp.send_message(message)
+        except TRANSIENT_ERRORS:
+            self.release(smtp, broken=True)
+            raise
+        except smtplib.SMTPException:
+            # The session is still usable after a rejected message, reset it for the next one
+            try:
+                smtp.rset()
+            except smtplib.SMTPException:
+                self.release(smtp, broken=True)
+                raise
+            self.release(smtp)
+            raise
+        except BaseException:
+            # Anything else (e.g. ssl.SSLError) leaves the session in an unknown state
+            self.release(smtp, broken=True)
+            raise
+        self.release(smtp)
+
+    def close(self):
+        """Close all idle connections; call once no more messages are being sent"""
+        opened = []
+        while not self._slots.empty():
+            opened.append(self._slots.get_nowait())
+        for smtp in opened:
+            if smtp is None:
+                continue
+            try:
+                smtp.quit()
+            except (smtplib.SMTPException, OSError):
+                smtp.close()
+        for _ in opened:
+            self._slots.put(None)
+
+
+def build_invoice_message(invoice, customer, pdf_bytes, recipient):
+    message = EmailMessage()
+    message['From'] = f"{config.COMPANY_NAME} <{config.COMPANY_EMAIL}>"
+    message['To'] = recipient
+    message['Subject'] = f"Ihre Rechnung {invoice['nr']} - {config.COMPANY_NAME}"
+    message.set_content(
+        f"Sehr geehrte/r {customer['name']},\n\n"
+        f"anbei erhalten Sie Ihre Rechnung {invoice['nr']} vom {invoice['date']} "
+        f"über {invoice['total']:.2f} €.\n\n"
+        "Bei Fragen stehen wir Ihnen gerne zur Verfügung.\n\n"
+        "Mit freundlichen Grüßen,\n"
+        f"{config.COMPANY_NAME}\n"
+        f"{config.COMPANY_ADDRESS}\n"
+        f"{config.COMPANY_PHONE}\n"
+    )
+    message.add_attachment(pdf_bytes, maintype='application', subtype='pdf',
+                           filename=invoice_pdf_filename(invoice, customer))
+    return message
+
+
+def _is_transient(error):
+    if isinstance(error, TRANSIENT_ERRORS):
+        return True
+    if isinstance(error, smtplib.SMTPRecipientsRefused):
+        # Has no smtp_code of its own; a 4xx on RCPT (e.g. greylisting) is worth retrying
+        codes = [code for code, _ in error.recipients.values()]
+        return bool(codes) and all(400 <= code < 500 for code in codes)
+    code = getattr(error, 'smtp_code', None)
+    return code is not None and 400 <= code < 500
+
+
+def _deliver(pool, message, retries, retry_delay):
+    """Send one message, retrying transient failures; returns (status, attempts, error)"""
+    attempts = 0
+    while True:
+        attempts += 1
+        try:
+            pool.send(message)
+            return STATUS_SENT, attempts, None
+        except (smtplib.SMTPException, OSError) as e:
+            if attempts > retries or not _is_transient(e):
+                return STATUS_FAILED, attempts, str(e)
+        time.sleep(retry_delay * 2 ** (attempts - 1))
+
+
+def send_invoices(invoice_ids, max_connections=4, retries=3, retry_delay=0.5,
+                  render_pdf=load_invoice_pdf, recipients=None, pool=None, resend=False, render_workers=None):
+    """
+    Send a batch of invoices by e-mail
+
+    Args:
+        invoice_ids: Ids of the invoices to send
+        max_connections: Number of SMTP connections (and concurrent sends)
+        retries: Retries per invoice for transient SMTP/network errors
+        retry_delay: Initial back-off in seconds, doubled on every retry
+        render_pdf: Module-level function (invoice, customer, items) -> PDF bytes; it runs
+            in worker processes and gets the rows as dicts
+        recipients: Optional mapping invoice_id -> address, overrides customers.email
+        pool: Optional SMTPConnectionPool, e.g. pointing at a local test server
+        resend: Also send invoices that invoice_deliveries already marks as sent
+        render_workers: Number of PDF render processes, defaults to the number of CPUs
+
+    Returns:
+        Dict mapping invoice_id to its delivery status
+    """
+    recipients = recipients or {}
+    own_pool = pool is None
+    if own_pool:
+        pool = SMTPConnectionPool(size=max_connections)
+
+    results = {}
+    renders = {}
+    jobs = {}
+    try:
+        # spawn, not fork: the parent runs the db writer thread, which must not be copied
+        with ProcessPoolExecutor(max_workers=render_workers, mp_context=multiprocessing.get_context("spawn")) as renderer, \
+                ThreadPoolExecutor(max_workers=max_connections) as executor:
+            for invoice_id in invoice_ids:
+                invoice, items = db.get_invoice_details(invoice_id)
+                if invoice is None:
+                    results[invoice_id] = STATUS_SKIPPED
+                    db.record_invoice_delivery(invoice_id, None, STATUS_SKIPPED, 0, 'Rechnung nicht gefunden')
+                    continue
+                if not resend:
+                    delivery = db.get_invoice_delivery(invoice_id)
+                    if delivery is not None and delivery['status'] == STATUS_SENT:
+                        results[invoice_id] = STATUS_ALREADY_SENT
+                        continue
+                customer = db.get_customer_by_id(invoice['customer_id'])
+                recipient = recipients.get(invoice_id) or customer['email']
+                if not recipient:
+                    results[invoice_id] = STATUS_SKIPPED
+                    db.record_invoice_delivery(invoice_id, None, STATUS_SKIPPED, 0, 'Keine E-Mail-Adresse hinterlegt')
+                    continue
+                # Rows are converted to dicts so they can be sent to the render processes
+                invoice, customer, items = dict(invoice), dict(customer), [dict(item) for item in items]
+                future = renderer.submit(render_pdf, invoice, customer, items)
+                renders[future] = (invoice_id, invoice, customer, recipient)
+
+            # One broken invoice (PDF, invalid address, ...) must not stop the rest of the batch
+            for future in as_completed(renders):
+                invoice_id, invoice, customer, recipient = renders[future]
+                try:
+                    pdf_bytes = future.result()
+                except Exception as e:
+                    results[invoice_id] = STATUS_FAILED
+                    db.record_invoice_delivery(invoice_id, recipient, STATUS_FAILED, 0, f"PDF: {e}")
+                    continue
+                try:
+                    message = build_invoice_message(invoice, customer, pdf_bytes, recipient)
+                except Exception as e:
+                    results[invoice_id] = STATUS_FAILED
+                    db.record_invoice_delivery(invoice_id, recipient, STATUS_FAILED, 0, f"E-Mail: {e}")
+                    continue
+                future = executor.submit(_deliver, pool, message, retries, retry_delay)
+                jobs[future] = (invoice_id, recipient)
+
+            # Status rows are written from this thread only, so the workers never wait on the database
+            for future in as_completed(jobs):
+                invoice_id, recipient = jobs[future]
+                try:
+                    status, attempts, error = future.result()
+                except Exception as e:
+                    status, attempts, error = STATUS_FAILED, 1, str(e)
+                results[invoice_id] = status
+                db.record_invoice_delivery(invoice_id, recipient, status, attempts, error)
+    finally:
+        if own_pool:
+            pool.close()
+    return results
+
+
+def main():
+    """Send the invoices given on the command line"""
+    parser = argparse.ArgumentParser(description="Rechnungen per E-Mail versenden")
+    parser.add_argument("invoice_ids", type=int, nargs="+")
+    parser.add_argument("--force", action="store_true", help="Bereits versendete Rechnungen erneut senden")
+    args = parser.parse_args()
+
+    db.init_db()
+    started = time.perf_counter()
+    results = send_invoices(args.invoice_ids, resend=args.force)
+    elapsed = time.perf_counter() - started
+
+    sent = sum(1 for status in results.values() if status == STATUS_SENT)
+    print(f"✅ {sent}/{len(results)} Rechnungen in {elapsed:.1f}s versendet")
+    for invoice_id, status in results.items():
+        if status == STATUS_ALREADY_SENT:
+            print(f"ℹ️ Rechnung {invoice_id}: bereits versendet (--force sendet erneut)")
+        elif status != STATUS_SENT:
+            print(f"❌ Rechnung {invoice_id}: {status}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
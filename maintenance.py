@@ -0,0 +1,256 @@
+#!/usr/bin/env python3
+"""
+Database maintenance for glanzwerk.db
+
+Online backups use the sqlite3 backup API and copy the whole database in
+one step from a read snapshot; with WAL (set by db.init_db) running sessions
+keep reading and writing meanwhile. The maintenance run keeps the database compact and
+the query planner statistics fresh. Switching an existing database to
+incremental auto-vacuum needs one full VACUUM, which only `run --full` does:
+
+    python maintenance.py backup [--dir backups] [--keep 14]
+    python maintenance.py run [--full]
+    python maintenance.py schedule [--hours 24]
+    python maintenance.py rebuild-stats
+    python maintenance.py dedup-customers [--apply]
+"""
+
+import argparse
+import os
+import sqlite3
+import sys
+import threading
+import time
+from datetime import datetime
+
+import db
+
+BACKUP_DIR = "backups"
+BACKUP_KEEP = 14
+# Retries (0.25 s apart) while the source stays locked before a backup is given up
+BACKUP_MAX_RETRIES = 120
+INCREMENTAL_VACUUM_PAGES = 1000
+
+_scheduler_thread = None
+_scheduler_lock = threading.Lock()
+
+
+def _connect():
+    # Maintenance runs alongside the app, so wait for locks instead of failing
+    return sqlite3.connect(db.DATABASE_NAME, timeout=30)
+
+
+def backup(backup_dir=BACKUP_DIR, keep=BACKUP_KEEP, max_retries=BACKUP_MAX_RETRIES):
+    """
+    Take an online backup of the database
+
+    The copy is made in a single backup step. A step-wise copy starts over
+    whenever another connection writes, so under steady load it never
+    finishes; in WAL mode the single step reads one snapshot and does not
+    block writers.
+
+    Args:
+        backup_dir: Directory for the backup files
+        keep: Number of backups to keep, older ones are removed
+        max_retries: Retries while the source is locked before giving up
+
+    Returns:
+        Path of the new backup file
+    """
+    os.makedirs(backup_dir, exist_ok=True)
+    name = f"glanzwerk_{datetime.now().strftime('%Y%m%d_%H%M%S')}.db"
+    target_path = os.path.join(backup_dir, name)
+    partial_path = target_path + ".part"
+
+    attempts = 0
+
+    def check_progress(status, remaining, total):
+        # Called after every step; with pages=-1 only BUSY/LOCKED leads to another step
+        nonlocal attempts
+        attempts += 1
+        if status in (sqlite3.SQLITE_BUSY, sqlite3.SQLITE_LOCKED) and attempts > max_retries:
+            raise sqlite3.OperationalError(f"Backup nach {attempts} Versuchen abgebrochen, Datenbank gesperrt")
+
+    source = _connect()
+    target = sqlite3.connect(partial_path)
+    try:
+        source.backup(target, pages=-1, progress=check_progress)
+    except BaseException:
+        # A failed backup leaves no partial file behind
+        target.close()
+        os.remove(partial_path)
+        raise
+    finally:
+        target.close()
+        source.close()
+    # Only a complete copy gets the final name
+    os.replace(partial_path, target_path)
+
+    backups = sorted(f for f in os.listdir(backup_dir) if f.startswith("glanzwerk_") and f.endswith(".db"))
+    for old in backups[:-keep] if keep else []:
+        os.remove(os.path.join(backup_dir, old))
+    return target_path
+
+
+def _timed(report, task, func):
+    started = time.perf_counter()
+    result = func()
+    report.append((task, time.perf_counter() - started, result))
+
+
+def _enable_incremental_vacuum(conn):
+    """Switch the database to incremental auto-vacuum; needs one full VACUUM"""
+    conn.execute("PRAGMA auto_vacuum = INCREMENTAL")
+    conn.execute("VACUUM")
+    return "auto_vacuum=INCREMENTAL"
+
+
+def _incremental_vacuum(conn, pages):
+    free_before = conn.execute("PRAGMA freelist_count").fetchone()[0]
+    conn.execute(f"PRAGMA incremental_vacuum({int(pages)})").fetchall()
+    free_after = conn.execute("PRAGMA freelist_count").fetchone()[0]
+    return f"{free_before - free_after} Seiten freigegeben"
+
+
+def run_maintenance(full=False, vacuum_pages=INCREMENTAL_VACUUM_PAGES):
+    """
+    Run the maintenance tasks and return a timing report
+
+    The default run is cheap enough for a live system: integrity quick check,
+    a bounded incremental vacuum and PRAGMA optimize. full=True runs the full
+    integrity_check and ANALYZE instead, and switches the database to
+    incremental auto-vacuum if needed; that VACUUM rewrites the whole file and
+    blocks all writers, so it is never done by the scheduler.
+
+    Returns:
+        List of (task, seconds, result) tuples
+    """
+    report = []
+    conn = _connect()
+    try:
+        if full:
+            _timed(report, "integrity_check", lambda: conn.execute("PRAGMA integrity_check").fetchone()[0])
+        else:
+            _timed(report, "quick_check", lambda: conn.execute("PRAGMA quick_check").fetchone()[0])
+
+        if conn.execute("PRAGMA auto_vacuum").fetchone()[0] == 2:
+            _timed(report, "incremental_vacuum", lambda: _incremental_vacuum(conn, vacuum_pages))
+        elif full:
+            _timed(report, "enable_incremental_vacuum", lambda: _enable_incremental_vacuum(conn))
+        else:
+            report.append(("incremental_vacuum", 0.0, "übersprungen, einmalig 'run --full' ausführen"))
+
+        if full:
+            _timed(report, "analyze", lambda: conn.execute("ANALYZE").fetchall() or "ok")
+        _timed(report, "optimize", lambda: conn.execute("PRAGMA optimize").fetchall() or "ok")
+    finally:
+        conn.close()
+    return report
+
+
+def print_report(report):
+    for task, seconds, result in report:
+        print(f"  {task:<28} {seconds * 1000:9.1f} ms  {result}")
+
+
+def _seconds_until_due(interval_hours, backup_dir):
+    """Time until the next backup, measured from the newest existing one"""
+    try:
+        newest = max(os.path.getmtime(os.path.join(backup_dir, f)) for f in os.listdir(backup_dir)
+                     if f.startswith("glanzwerk_") and f.endswith(".db"))
+    except (FileNotFoundError, ValueError):
+        return 0
+    return max(0, newest + interval_hours * 3600 - time.time())
+
+
+def _scheduler_loop(interval_hours, backup_dir, stop_event):
+    # A process that restarts more often than the interval must still back up
+    wait = _seconds_until_due(interval_hours, backup_dir)
+    while not stop_event.wait(wait):
+        wait = interval_hours * 3600
+        try:
+            path = backup(backup_dir)
+            print(f"✅ Backup erstellt: {path}")
+            print_report(run_maintenance())
+        except (sqlite3.Error, OSError) as e:
+            print(f"❌ Wartung fehlgeschlagen: {e}")
+
+
+def start_maintenance_scheduler(interval_hours=24, backup_dir=BACKUP_DIR):
+    """
+    Start backups and maintenance in a background thread
+
+    Safe to call on every Streamlit rerun: only one scheduler is started per
+    process. Returns the threading.Event that stops it.
+    """
+    global _scheduler_thread
+    with _scheduler_lock:
+        if _scheduler_thread is None or not _scheduler_thread.is_alive():
+            stop_event = threading.Event()
+            _scheduler_thread = threading.Thread(target=_scheduler_loop, args=(interval_hours, backup_dir, stop_event),
+                                                 name="glanzwerk-maintenance", daemon=True)
+            _scheduler_thread.stop_event = stop_event
+            _scheduler_thread.start()
+        return _scheduler_thread.stop_event
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Datenbankwartung für glanzwerk.db")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    backup_parser = subparsers.add_parser("backup", help="Online-Backup erstellen")
+    backup_parser.add_argument("--dir", default=BACKUP_DIR)
+    backup_parser.add_argument("--keep", type=int, default=BACKUP_KEEP)
+
+    run_parser = subparsers.add_parser("run", help="Wartung ausführen")
+    run_parser.add_argument("--full", action="store_true", help="integrity_check, ANALYZE und einmalige Umstellung auf inkrementelles VACUUM")
+
+    schedule_parser = subparsers.add_parser("schedule", help="Backup und Wartung regelmäßig ausführen")
+    schedule_parser.add_argument("--hours", type=float, default=24)
+    schedule_parser.add_argument("--dir", default=BACKUP_DIR)
+
+    subparsers.add_parser("rebuild-stats", help="Kundenstatistiken neu berechnen")
+    dedup_parser = subparsers.add_parser("dedup-customers", help="Doppelte Kunden desselben Fahrzeugs anzeigen")
+    dedup_parser.add_argument("--apply", action="store_true", help="Angezeigte Kunden wirklich zusammenführen")
+
+    args = parser.parse_args()
+
+    if args.command == "backup":
+        started = time.perf_counter()
+        path = backup(args.dir, args.keep)
+        print(f"✅ Backup erstellt: {path} ({time.perf_counter() - started:.2f}s)")
+    elif args.command == "run":
+        print("Wartung:")
+        print_report(run_maintenance(full=args.full))
+    elif args.command == "rebuild-stats":
+        started = time.perf_counter()
+        db.init_db()
+        db.rebuild_customer_stats()
+        print(f"✅ Kundenstatistiken neu berechnet ({time.perf_counter() - started:.2f}s)")
+    elif args.command == "dedup-customers":
+        db.init_db()
+        merges = db.find_duplicate_customers()
+        if not merges:
+            print("✅ Keine doppelten Kunden gefunden")
+            return 0
+        for customer_id, name, keeper_id, keeper_name, kfz in merges:
+            warning = "  ⚠️ Name weicht ab" if name.strip().casefold() != keeper_name.strip().casefold() else ""
+            print(f"  {kfz}: #{customer_id} {name} -> #{keeper_id} {keeper_name}{warning}")
+        if not args.apply:
+            print(f"ℹ️ {len(merges)} Kunden würden zusammengeführt, mit --apply ausführen")
+            return 0
+        # Merging deletes customers, so keep a way back
+        print(f"✅ Backup erstellt: {backup()}")
+        merged = db.dedup_customers()
+        print(f"✅ {len(merged)} doppelte Kunden zusammengeführt")
+    else:
+        stop_event = threading.Event()
+        try:
+            _scheduler_loop(args.hours, args.dir, stop_event)
+        except KeyboardInterrupt:
+            pass
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
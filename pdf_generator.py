@@ -1,14 +1,25 @@
 from fpdf import FPDF
+from fpdf.image_datastructures import ImageCache
 import os
+import threading
+
+import config
+
+# Parsed logo per thread, reused by render_invoice_pdf for every document
+_image_caches = threading.local()
 
 class InvoicePDF(FPDF):
-    def __init__(self):
+    def __init__(self, image_cache=None):
         super().__init__()
-        self.add_page()
+        if image_cache is not None:
+            # The header draws the logo on the first page, so the cache has to be set before it
+            self.image_cache = image_cache
         self.set_auto_page_break(auto=True, margin=15)
         self.FONT_PATH = os.path.join(os.path.dirname(__file__), 'assets', 'DejaVuSans.ttf')
+        # The header uses this font, so it has to be registered before the first page
         self.add_font("DejaVuSans", "", self.FONT_PATH, uni=True)
         self.set_font("DejaVuSans", "", 10)
+        self.add_page()
 
     def header(self):
         # Logo
@@ -39,8 +50,9 @@ class InvoicePDF(FPDF):
         self.cell(0, 5, 'Kunde:', 0, 1, 'L')
         self.set_font('DejaVuSans', '', 10)
         self.cell(0, 5, customer_data['name'], 0, 1, 'L')
-        self.cell(0, 5, customer_data['address'], 0, 1, 'L')
-        self.cell(0, 5, customer_data['phone'], 0, 1, 'L')
+        self.cell(0, 5, f"KFZ: {customer_data['kfz']}", 0, 1, 'L')
+        if customer_data['tel']:
+            self.cell(0, 5, customer_data['tel'], 0, 1, 'L')
         self.ln(10)
 
         # Invoice items table header
@@ -48,39 +60,44 @@ class InvoicePDF(FPDF):
         self.cell(10, 10, 'Pos', 1, 0, 'C')
         self.cell(80, 10, 'Leistung', 1, 0, 'C')
         self.cell(20, 10, 'Menge', 1, 0, 'C')
-        self.cell(30, 10, 'Einzelpreis', 1, 0, 'C')
-        self.cell(20, 10, 'Rabatt', 1, 0, 'C')
-        self.cell(30, 10, 'Gesamtpreis', 1, 1, 'C')
+        self.cell(40, 10, 'Einzelpreis', 1, 0, 'C')
+        self.cell(40, 10, 'Gesamtpreis', 1, 1, 'C')
 
-        total_amount = 0
         for i, item in enumerate(invoice_items):
-            service_name = item['service_name']
-            quantity = item['qty']
-            unit_price = item['price']
-            discount = item['discount']
-
-            item_total = (unit_price * quantity) * (1 - discount / 100)
-            total_amount += item_total
-
             self.cell(10, 10, str(i + 1), 1, 0, 'C')
-            self.cell(80, 10, service_name, 1, 0, 'L')
-            self.cell(20, 10, str(quantity), 1, 0, 'C')
-            self.cell(30, 10, f"{unit_price:.2f}€", 1, 0, 'R')
-            self.cell(20, 10, f"{discount}%", 1, 0, 'C')
-            self.cell(30, 10, f"{item_total:.2f}€", 1, 1, 'R')
+            self.cell(80, 10, item['service_name'], 1, 0, 'L')
+            self.cell(20, 10, f"{item['qty']:g}", 1, 0, 'C')
+            self.cell(40, 10, f"{item['unit_price']:.2f}€", 1, 0, 'R')
+            self.cell(40, 10, f"{item['line_total']:.2f}€", 1, 1, 'R')
 
         self.ln(10)
 
-        # Total amount
+        # Totals as stored with the invoice
         self.set_font('DejaVuSans', '', 12)
-        self.cell(0, 10, f"Gesamtbetrag: {total_amount:.2f}€", 0, 1, 'R')
-
-        # VAT (Example: 19%)
-        vat_rate = 0.19
-        vat_amount = total_amount * vat_rate
-        self.cell(0, 10, f"zzgl. 19% MwSt.: {vat_amount:.2f}€", 0, 1, 'R')
-        self.cell(0, 10, f"Rechnungsbetrag inkl. MwSt.: {total_amount + vat_amount:.2f}€", 0, 1, 'R')
-
-        self.output(f"invoice_{invoice_data['nr']}.pdf")
+        self.cell(0, 10, f"Zwischensumme: {invoice_data['subtotal']:.2f}€", 0, 1, 'R')
+        if invoice_data['rabatt']:
+            self.cell(0, 10, f"Rabatt: -{invoice_data['rabatt']:.2f}€", 0, 1, 'R')
+        self.cell(0, 10, f"zzgl. {config.VAT_RATE:.0%} MwSt.: {invoice_data['mwst']:.2f}€", 0, 1, 'R')
+        self.cell(0, 10, f"Rechnungsbetrag inkl. MwSt.: {invoice_data['total']:.2f}€", 0, 1, 'R')
+
+    def output_pdf(self, path):
+        self.output(path)
+
+
+def _shared_image_cache():
+    # Decoding and recompressing the logo is the slowest part of a render, so it
+    # is done once per thread; reset_usages() makes the cache safe for the next document
+    cache = getattr(_image_caches, "cache", None)
+    if cache is None:
+        cache = _image_caches.cache = ImageCache()
+    cache.reset_usages()
+    return cache
+
+
+def render_invoice_pdf(invoice_data, customer_data, invoice_items):
+    """Render an invoice from database rows and return the PDF bytes"""
+    pdf = InvoicePDF(image_cache=_shared_image_cache())
+    pdf.create_invoice(invoice_data, customer_data, invoice_items)
+    return bytes(pdf.output())
 
 
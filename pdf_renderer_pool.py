@@ -0,0 +1,167 @@
+#!/usr/bin/env python3
+"""
+Warm WeasyPrint renderer pool for the HTML invoice template
+
+Importing WeasyPrint, loading its lazy modules and setting up fonts takes
+seconds, and a plain generate_invoice_pdf call pays all of it every time.
+The pool keeps a few worker processes alive that have WeasyPrint and the
+font configuration loaded, cache the embedded images, and turn HTML into
+PDF bytes:
+
+    pool = get_renderer_pool()
+    generate_invoice_pdf(..., renderer_pool=pool)
+
+Workers render through generate_pdf.write_pdf_bytes, the same function the
+in-process path uses, so the template's <style> block keeps its author
+origin in the cascade. The stylesheet itself is still parsed on every job:
+WeasyPrint has no public way to hand in a pre-parsed author stylesheet, and
+passing it through write_pdf(stylesheets=...) would make it user CSS and
+change which rules win.
+
+    python pdf_renderer_pool.py            cold vs. warm timings
+    python pdf_renderer_pool.py --compare  pool render vs. in-process render
+
+The parent process never imports WeasyPrint itself.
+"""
+
+import argparse
+import multiprocessing
+import re
+import sys
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+import generate_pdf
+
+MAX_CACHED_IMAGES = 64
+
+# State of a worker process, set up once by _init_worker
+_font_config = None
+_image_cache = {}
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def _init_worker(warm_up_html):
+    global _font_config
+    from weasyprint.text.fonts import FontConfiguration
+
+    _font_config = FontConfiguration()
+    if warm_up_html:
+        # One throwaway render loads the fonts and WeasyPrint's lazy modules
+        _render(warm_up_html, ".")
+
+
+def _render(html, base_url):
+    if len(_image_cache) > MAX_CACHED_IMAGES:
+        _image_cache.clear()
+
+    return generate_pdf.write_pdf_bytes(html, base_url, font_config=_font_config, cache=_image_cache)
+
+
+def _worker_ready():
+    return True
+
+
+class RendererPool:
+    """Persistent worker processes that render HTML to PDF bytes"""
+
+    def __init__(self, workers=2, warm_up=True):
+        self.workers = workers
+        self.warm_up_html = generate_pdf.build_invoice_html() if warm_up else None
+        self._executor = None
+        self._start()
+
+    def _start(self):
+        # spawn, not fork: the parent (Streamlit) runs threads that must not be copied
+        self._executor = ProcessPoolExecutor(
+            max_workers=self.workers,
+            mp_context=multiprocessing.get_context("spawn"),
+            initializer=_init_worker,
+            initargs=(self.warm_up_html,),
+        )
+        # Start all workers now, so the first real job does not pay the warm-up
+        self._ready = [self._executor.submit(_worker_ready) for _ in range(self.workers)]
+
+    def wait_ready(self):
+        for future in self._ready:
+            future.result()
+
+    def submit(self, html, base_url="."):
+        """Queue an HTML document; returns a Future with the PDF bytes"""
+        return self._executor.submit(_render, html, base_url)
+
+    def render(self, html, base_url="."):
+        """Render an HTML document and return the PDF bytes"""
+        try:
+            return self.submit(html, base_url).result()
+        except BrokenProcessPool:
+            # A worker died (e.g. out of memory); start a fresh pool and retry once
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._start()
+            return self.submit(html, base_url).result()
+
+    def shutdown(self):
+        self._executor.shutdown()
+
+
+def get_renderer_pool(workers=2):
+    """Return the process-wide renderer pool, starting it on first use"""
+    global _pool
+    # Streamlit runs each session in its own thread; only one of them may start the pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = RendererPool(workers=workers)
+        return _pool
+
+
+def _strip_volatile(pdf_bytes):
+    # Creation date and document ID differ between any two renders
+    return re.sub(rb"/(CreationDate|ModDate) \([^)]*\)|/ID \[[^\]]*\]", b"", pdf_bytes)
+
+
+def compare(html=None):
+    """Render the same HTML in the pool and in this process; True if the PDFs match"""
+    html = html or generate_pdf.build_invoice_html()
+    pool = RendererPool(workers=1, warm_up=False)
+    try:
+        pooled = pool.render(html)
+    finally:
+        pool.shutdown()
+    local = generate_pdf.write_pdf_bytes(html)
+    print(f"Pool: {len(pooled)} Bytes, im Prozess: {len(local)} Bytes")
+    return _strip_volatile(pooled) == _strip_volatile(local)
+
+
+def main():
+    """Report cold vs. warm timings, or compare pool and in-process output"""
+    parser = argparse.ArgumentParser(description="WeasyPrint-Renderer-Pool")
+    parser.add_argument("--compare", action="store_true", help="Pool-Ausgabe mit In-Prozess-Ausgabe vergleichen")
+    args = parser.parse_args()
+
+    if args.compare:
+        if compare():
+            print("✅ Pool und In-Prozess-Rendering sind identisch")
+            return 0
+        print("❌ Pool und In-Prozess-Rendering weichen ab")
+        return 1
+
+    started = time.perf_counter()
+    pool = RendererPool(workers=1)
+    pool.wait_ready()
+    print(f"Pool bereit nach {time.perf_counter() - started:.2f}s")
+
+    html = generate_pdf.build_invoice_html()
+    for run in range(3):
+        started = time.perf_counter()
+        pdf_bytes = pool.render(html)
+        print(f"Render {run + 1}: {time.perf_counter() - started:.3f}s ({len(pdf_bytes)} Bytes)")
+    pool.shutdown()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())